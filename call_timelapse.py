@@ -1,109 +1,88 @@
 import os, sys
-import geopandas as gpd
 
-from sentinelhub import BBox, CRS
 from sattimelapse.time_lapse import SentinelHubTimelapse
-
-# Loading polygon of nominal water extent
-from shapely.wkt import loads
-
-
-with open('myID.txt') as f:
-    INSTANCE_ID = f.readline()
+from sattimelapse.estimate import get_catalogue_dates, get_catalogue_filename, estimate_run, suggest_settings, \
+    format_report
+from sattimelapse.planner import plan_request
+from sattimelapse.pipeline import timelapse_pipeline
+from sattimelapse.config import get_instance_id
+from sattimelapse.sites import bbox_creator, get_bbox_size, shp2wkt
 
 
 # wkt_file = 'theewaterskloof_dam_nominal.wkt'
 
-def bbox_creator(wkt_file, inflate_bbox=0.5, minsize=[0.025, 0.015]):
-    with open(wkt_file, 'r') as f:
-        wkt = f.read()
-
-    nominal = loads(wkt)
-
-    # inflate the BBOX
-    minx, miny, maxx, maxy = nominal.bounds
-    delx = maxx - minx
-    dely = maxy - miny
-
-    # set minimal frame size
-    delx = max(delx * inflate_bbox, minsize[0])
-    dely = max(dely * inflate_bbox, minsize[1])
-
-    minx = minx - delx
-    maxx = maxx + delx
-    miny = miny - dely
-    maxy = maxy + dely
-
-    return BBox(bbox=[minx, miny, maxx, maxy], crs=CRS.WGS84)
-
-
-def get_bbox_size(bbox):
-    from geographiclib.geodesic import Geodesic
-
-    geod = Geodesic.WGS84
-    b = bbox.get_polygon()
-    p1_lat, p1_lon = b[0][0], b[0][1]
-    p2_lat, p2_lon = b[1][0], b[1][1]
-    p3_lat, p3_lon = b[2][0], b[2][1]
-
-    gx = geod.Inverse(p1_lat, p1_lon, p2_lat, p2_lon)
-    gy = geod.Inverse(p2_lat, p2_lon, p3_lat, p3_lon)
-    print("Distance is E-W x N-S {:.2f}m x {:.2f}m".format(gx['s12'], gy['s12']))
-    return gx['s12'], gy['s12']
-
-
 def make_timelapse(msg, bbox, time_interval, *, mask_images=[], new=True, clean=False,
-                   max_cc=0.33, scale_factor=.43, fps=3, instance_id=INSTANCE_ID, **kwargs):
+                   max_cc=0.33, scale_factor=.43, fps=3, instance_id=None,
+                   select_window=None, select_months=None, max_hash_distance=None, quality_checks=False,
+                   renditions=None, **kwargs):
     global timelapse
-    timelapse = SentinelHubTimelapse(msg, bbox, time_interval, new, clean, instance_id, **kwargs)
+    timelapse = SentinelHubTimelapse(msg, bbox, time_interval, new, clean, get_instance_id(instance_id), **kwargs)
     if new:
-        timelapse.get_previews()
-        timelapse.save_fullres_images()
-        timelapse.plot_preview(filename='previews.pdf')
-        print('mask invalid images')
-        timelapse.mask_invalid_images(max_invalid_coverage=0.01)
-        print('mask cloudy images')
-        timelapse.mask_cloudy_images(max_cloud_coverage=max_cc)
-        timelapse.plot_cloud_masks(filename='cloudmasks.pdf')
-        timelapse.plot_fullres(filename='previews_with_cc.pdf')
-        timelapse.mask_images(mask_images)
-        timelapse.create_date_stamps()
-        timelapse.create_timelapse(scale_factor=scale_factor)
-
-    timelapse.make_video_alternate(fps=fps)
-
-
-def shp2wkt(shapefile):
-    tmp = gpd.GeoDataFrame.from_file(shapefile)
-    tmp.to_crs(epsg=4326, inplace=True)
-    wkt = tmp.geometry.values[0].to_wkt()
-
-    with open(shapefile.replace('shp', 'wkt'), "w") as text_file:
-        text_file.write(wkt)
-
-
-lake = 'RAV34'
-#
-# idir = sys.argv[1]
-# lake = sys.argv[2]
-#
-# project_name = os.path.join(idir, lake)
-# wkt_file = os.path.join(project_name, 'shape', lake + '.wkt')
-project_name =sys.argv[1]
-wkt_file = sys.argv[2]
-project_name ='/DATA/projet/Karaoun'
-wkt_file ='/DATA/projet/Karaoun/shape/Karaoun.wkt'
-time_interval = ['2015-05-01', '2018-09-30']
-
-if not os.path.isfile(wkt_file):
-    shp2wkt(wkt_file.replace('wkt', 'shp'))
-bbox = bbox_creator(wkt_file, 0.3)
-x,y = get_bbox_size(bbox)
-small_area = True
-if (x >= 40000) | (y >= 40000):
-    small_area = False
+        # stages whose parameters and inputs did not change since the last run are skipped,
+        # cache and downloader settings do not change the requested data
+        request_params = {key: value for key, value in kwargs.items()
+                          if key not in ('response_cache', 'async_downloader')}
+        pipeline = timelapse_pipeline(timelapse, request_params=dict(request_params, bbox=bbox,
+                                                                     time_interval=time_interval),
+                                      max_cc=max_cc, mask_images=mask_images, quality_checks=quality_checks,
+                                      max_hash_distance=max_hash_distance, select_window=select_window,
+                                      select_months=select_months, scale_factor=scale_factor, fps=fps,
+                                      renditions=renditions)
+        pipeline.run()
+    elif renditions:
+        timelapse.make_renditions(renditions, fps=fps)
+    else:
+        timelapse.make_video_alternate(fps=fps)
+
+
+def plan(msg, bbox, time_interval, *, budget=None, instance_id=None, **kwargs):
+    """
+    Dry run: queries the catalogue only (cached in pipeline/catalogue.json) and prints requests, processing units, bytes,
+    RAM and disk estimates per stage. With a ``budget`` such as {'peak_ram_bytes': 8e9}, suggests settings that fit.
+    """
+    dates = get_catalogue_dates(bbox, time_interval, instance_id=get_instance_id(instance_id),
+                                cache_file=get_catalogue_filename(msg))
+    estimate = estimate_run(get_bbox_size(bbox), len(dates), **kwargs)
+    print(format_report(estimate))
+
+    if budget:
+        suggestion = suggest_settings(get_bbox_size(bbox), len(dates), budget, **kwargs)
+        if suggestion is None:
+            print('No setting fits the budget {}, consider a shorter time interval.'.format(budget))
+        else:
+            print('Suggested settings within budget: {}'.format(suggestion[0]))
+    return estimate
+
+
+if __name__ == '__main__':
+    lake = 'RAV34'
+    #
+    # idir = sys.argv[1]
+    # lake = sys.argv[2]
+    #
+    # project_name = os.path.join(idir, lake)
+    # wkt_file = os.path.join(project_name, 'shape', lake + '.wkt')
+    # python -m sattimelapse plan|fetch|mask|render|encode|batch for other sites
+    dry_run = '--dry-run' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--dry-run']
+    project_name = args[0]
+    wkt_file = args[1]
+    project_name ='/DATA/projet/Karaoun'
+    wkt_file ='/DATA/projet/Karaoun/shape/Karaoun.wkt'
+    time_interval = ['2015-05-01', '2018-09-30']
+
+    if not os.path.isfile(wkt_file):
+        shp2wkt(wkt_file.replace('wkt', 'shp'))
+    bbox = bbox_creator(wkt_file, 0.3)
+    # resolutions and request type from the bbox size, the target frame size and per-product pixel budgets
+    request_kwargs, products = plan_request(get_bbox_size(bbox), target_size=(1920, 1080))
+    print('Planned products: {}'.format(products))
+
+    if dry_run:
+        plan(project_name, bbox, time_interval, **request_kwargs)
+    else:
+        make_timelapse(project_name, bbox, time_interval, new=True, clean=False, **request_kwargs)
 
-make_timelapse(project_name, bbox, time_interval, new=True, clean=False, small_area=small_area)
 
 #
 # from time_lapse import SentinelHubTimelapse
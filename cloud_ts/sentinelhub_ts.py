@@ -10,17 +10,16 @@ import glob
 
 from dateutil.rrule import rrule, MONTHLY
 
-from itertools import compress
-
-import cv2
-import imageio
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
 
-from sentinelhub.data_request import WmsRequest, WcsRequest
-from sentinelhub.constants import MimeType, CustomUrlParam
-from s2cloudless import CloudMaskRequest, MODEL_EVALSCRIPT
+from sattimelapse.frames import FramesMixin
+from sattimelapse.quantize import Quantizer
+from sattimelapse.response_cache import ResponseCache
+from sattimelapse.dates import to_datetime64, calendar_filter, window_index, select_best_per_window
+from sattimelapse.harmonize import apply_lut
+from sattimelapse.locking import folder_lock, atomic_path
+from sattimelapse.async_client import AsyncDownloader
+from cloud_ts.zonal import ZonalStats
 
 appdir = os.path.dirname(os.path.abspath(__file__))
 datestamps_dir = os.path.join(appdir, 'datestamps')
@@ -28,7 +27,7 @@ datestamps_dir = os.path.join(appdir, 'datestamps')
 LOGGER = logging.getLogger(__name__)
 
 
-class timeseries(object):
+class timeseries(FramesMixin):
     """
     Class for creating timeseries with satellite images available through SentinelHub portal
     """
@@ -38,7 +37,8 @@ class timeseries(object):
                  full_size=(1920, 1080), preview_size=(600, None),
                  use_atmcor=False, layer='TRUE-COLOR-S2-L1C',
                  custom_script='return [B01,B02,B04,B05,B08,B8A,B09,B10,B11,B12]',
-                 time_difference=datetime.timedelta(hours=2), pix_based=False):
+                 time_difference=datetime.timedelta(hours=2), pix_based=False, storage_dtype=None,
+                 response_cache=None, async_downloader=None):
 
         self.project_name = project_name
         self.preview_folder = os.path.join(project_name, 'data', 'previews')
@@ -50,6 +50,21 @@ class timeseries(object):
         self.previews = None
         self.full_res = full_res
         self.timelapse = None
+        self.bbox = bbox
+        self.coverage_table = None
+        self.luts = None
+        self.custom_band_names = ZonalStats.parse_band_names(custom_script)
+        # reflectance and probabilities do not need float32: optional uint16 (scale/offset) or float16 storage
+        self.custom_quantizer = Quantizer(storage_dtype, scale=1e-4)
+        self.prob_quantizer = Quantizer(storage_dtype, scale=1. / (Quantizer.NODATA - 1))
+        self.custom_bands = None
+        self.cloud_probs = None
+        # shared cache of raw responses, True for the default location
+        self.response_cache = ResponseCache() if response_cache is True else response_cache
+        # asyncio download layer, True for default settings with a journal in the project folder
+        if async_downloader is True:
+            async_downloader = AsyncDownloader(journal_filename=os.path.join(project_name, 'download_journal.jsonl'))
+        self.async_downloader = async_downloader
 
         if clean:
             self.clean_all()
@@ -57,6 +72,10 @@ class timeseries(object):
         if not new:
             return
 
+        # request libraries are only needed to download
+        from sentinelhub.data_request import WmsRequest, WcsRequest
+        from sentinelhub.constants import MimeType, CustomUrlParam
+
         if pix_based:
             self.preview_request = WcsRequest(data_folder=self.preview_folder, layer=layer, bbox=bbox,
                                               time=time_interval, resx=preview_res[0], resy=preview_res[1],
@@ -117,6 +136,8 @@ class timeseries(object):
         #     raise ValueError('List of previews and cloud masks do not match.')
         self.dates = np.array(self.dates)
         self.mask = np.zeros((len(self.dates),), dtype=np.uint8)
+        # vectorised index of the dates for calendar filters and window grouping
+        self.dates64 = to_datetime64(self.dates)
 
         LOGGER.info('Found %d images of %s between %s and %s.', len(self.dates), project_name,
                     time_interval[0], time_interval[1])
@@ -141,7 +162,7 @@ class timeseries(object):
         Set `redownload` to True if to force downloading the previews again.
         """
 
-        self.previews = np.asarray(self.preview_request.get_data(save_data=save_data, redownload=redownload))
+        self.previews = np.asarray(self._get_request_data(self.preview_request, save_data, redownload))
         self.preview_transparency_data = self.previews[:, :, :, -1]
 
         LOGGER.info('%d previews have been downloaded and stored to numpy array of shape %s.', self.previews.shape[0],
@@ -154,20 +175,105 @@ class timeseries(object):
         cloud coverage.
         """
 
-        data4d = np.asarray(self.fullres_request.get_data(save_data=save_data, redownload=redownload))
+        data4d = np.asarray(self._get_request_data(self.fullres_request, save_data, redownload))
         self.full_res_data = data4d[:, :, :, :-1]
         self.transparency_data = data4d[:, :, :, -1]
 
-    def get_custom(self, save_data=True, redownload=False):
+    def _get_request_data(self, request, save_data=True, redownload=False, **kwargs):
         """
-        Downloads and saves custom-band images
+        Returns data of ``request``, consulting the shared response cache first and downloading missing responses
+        with the asynchronous downloader if they are set and data are saved.
+        """
+        if not save_data:
+            return request.get_data(save_data=False, redownload=redownload, **kwargs)
+
+        with folder_lock(request.data_folder):
+            data_filter = kwargs.get('data_filter')
+            if self.response_cache is not None and not redownload:
+                self.response_cache.fill(request, data_filter)
+            if self.async_downloader is not None:
+                self.async_downloader.prefetch(request, data_filter=data_filter, redownload=redownload)
+                redownload = False
+
+            data = request.get_data(save_data=True, redownload=redownload, **kwargs)
+
+            if self.response_cache is not None:
+                self.response_cache.store(request, data_filter)
+            return data
+
+    def get_custom(self, save_data=True, redownload=False, chunk_size=32):
+        """
+        Downloads and saves custom-band images. Images are requested ``chunk_size`` dates at a time and stored in
+        ``self.custom_bands`` in the storage dtype, use ``get_custom_reflectance`` to read float32 values.
         """
 
         self.custom_dates = self.custom_request.get_dates()
-        self.custom_bands = np.asarray(self.custom_request.get_data(save_data=save_data, redownload=redownload))
+        self.custom_bands = None
+        for start in range(0, len(self.custom_dates), chunk_size):
+            stop = min(start + chunk_size, len(self.custom_dates))
+            data = self._get_request_data(self.custom_request, save_data, redownload,
+                                          data_filter=list(range(start, stop)))
+            encoded = self.custom_quantizer.encode_stack(data)
+            if self.custom_bands is None:
+                self.custom_bands = np.empty((len(self.custom_dates),) + encoded.shape[1:], dtype=encoded.dtype)
+            self.custom_bands[start:stop] = encoded
+
         LOGGER.info('%d tiff data have been downloaded and stored to numpy array of shape %s.', self.custom_bands.shape[0],
                     self.custom_bands.shape)
 
+    def get_custom_reflectance(self, start=None, stop=None):
+        """
+        Returns float32 custom-band values of dates ``start:stop``, dequantised from the storage dtype.
+        """
+        return self.custom_quantizer.decode(self.custom_bands[start:stop])
+
+    def get_zonal_stats(self, geometry, filename=None, chunk_size=16, **kwargs):
+        """
+        Computes per-date zonal statistics of the custom bands over ``geometry`` (e.g. the lake polygon), over clear
+        pixels only, and returns them as a tidy table.
+
+        If custom bands were already loaded with ``get_custom`` they are reduced chunk by chunk together with
+        ``self.dates`` and ``self.cloud_masks``; otherwise the saved custom data are read chunk by chunk so that the
+        whole cube is never held in memory.
+
+        :param geometry: polygon of the water body, WGS84
+        :type geometry: shapely geometry or str (WKT)
+        :param filename: csv file name within project folder, the table is not written if None
+        :type filename: str or None
+        :param chunk_size: number of dates reduced in one pass
+        :type chunk_size: int
+        :param kwargs: parameters passed to ``ZonalStats`` (percentiles, water_bands, water_threshold, pixel_area)
+        :return: table with columns date, band, statistic, value
+        :rtype: pandas.DataFrame
+        """
+        if self.custom_bands is not None:
+            dates = self.dates
+            cloud_masks = self.cloud_masks
+
+            def read_chunk(start, stop):
+                return self.get_custom_reflectance(start, stop)
+        else:
+            dates = self.custom_request.get_dates()
+            cloud_masks = self.cloud_masks if self.cloud_masks is not None and \
+                len(self.cloud_masks) == len(dates) else None
+
+            def read_chunk(start, stop):
+                return self.custom_quantizer.decode(np.asarray(
+                    self._get_request_data(self.custom_request, data_filter=list(range(start, stop)))))
+
+        zonal = None
+        for start in range(0, len(dates), chunk_size):
+            stop = min(start + chunk_size, len(dates))
+            cube = read_chunk(start, stop)
+            if zonal is None:
+                zonal = ZonalStats(geometry, self.bbox, cube.shape[1:3], self.custom_band_names, **kwargs)
+            zonal.update(dates[start:stop], cube, cloud_masks[start:stop] if cloud_masks is not None else None)
+
+        table = zonal.to_dataframe()
+        if filename:
+            table.to_csv(os.path.join(self.project_name, filename), index=False)
+        return table
+
     def overlay_cloud_mask(self, rgb_img, mask, within_range=None, filename=None):
         """
         Utility function for plotting RGB images with binary mask overlayed.
@@ -194,11 +300,14 @@ class timeseries(object):
         """
         Plots all cloud masks if within_range is None, or only masks in a given range.
         """
+        import matplotlib.pyplot as plt
+
         within_range = CommonUtil.get_within_range(within_range, self.cloud_masks.shape[0])
         self._plot_image(self.cloud_masks[within_range[0]: within_range[1]],
                          factor=1, cmap=plt.cm.binary, filename=filename)
 
     def _plot_image(self, data, factor=2.5, cmap=None, ctitle='', mask=None, filename=None):
+        import matplotlib.pyplot as plt
 
         rows = data.shape[0] // 5 + (1 if data.shape[0] % 5 else 0)
         aspect_ratio = (1.0 * data.shape[1]) / data.shape[2]
@@ -251,45 +360,58 @@ class timeseries(object):
         if not os.path.exists(self.project_name + '/cloudmasks'):
             os.makedirs(self.project_name + '/cloudmasks')
 
-        with open(cloud_masks_filename, 'wb') as fp:
+        with atomic_path(cloud_masks_filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
             np.save(fp, self.cloud_masks)
+        # tables of the previous masks are stale
+        self._reset_coverage_tables()
 
     def _load_cloud_probs(self):
         """
-        Loads masks from disk, if they already exist.
+        Loads cloud probabilities from disk, if they already exist, in the storage dtype as after cloud detection.
         """
-        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npy'
+        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npz'
+        if not os.path.isfile(cloud_probs_filename):
+            # written by earlier versions
+            cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npy'
 
         if not os.path.isfile(cloud_probs_filename):
             return False
 
         with open(cloud_probs_filename, 'rb') as fp:
-            self.cloud_probs = np.load(fp)
+            # the file may have been written with another storage dtype
+            self.cloud_probs = self.prob_quantizer.encode(Quantizer.load(fp))
         return True
 
+    def get_cloud_probs(self, start=None, stop=None):
+        """
+        Returns float32 cloud probabilities of dates ``start:stop``, dequantised from the storage dtype.
+        """
+        return self.prob_quantizer.decode(self.cloud_probs[start:stop])
+
     def _save_cloud_probs(self):
         """
-        Saves masks to disk.
+        Saves cloud probabilities to disk in the storage dtype.
         """
-        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npy'
+        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npz'
 
         if not os.path.exists(self.project_name + '/cloudmasks'):
             os.makedirs(self.project_name + '/cloudmasks')
 
-        with open(cloud_probs_filename, 'wb') as fp:
-            np.save(fp, self.cloud_probs)
+        with atomic_path(cloud_probs_filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
+            self.prob_quantizer.save(fp, self.cloud_probs)
 
     def _run_cloud_detection(self, rerun, threshold):
         """
         Determines cloud masks for each acquisition.
         """
-        loaded = self._load_cloud_masks()
-        if loaded and not rerun:
-            LOGGER.info('Nothing to do. Masks are loaded.')
-        else:
-            LOGGER.info('Downloading cloud data and running cloud detection. This may take a while.')
-            self.cloud_masks = self.cloud_mask_request.get_cloud_masks(threshold=threshold)
-            self._save_cloud_masks()
+        with folder_lock(os.path.join(self.project_name, 'cloudmasks')):
+            loaded = self._load_cloud_masks()
+            if loaded and not rerun:
+                LOGGER.info('Nothing to do. Masks are loaded.')
+            else:
+                LOGGER.info('Downloading cloud data and running cloud detection. This may take a while.')
+                self.cloud_masks = self.cloud_mask_request.get_cloud_masks(threshold=threshold)
+                self._save_cloud_masks()
 
     def mask_cloudy_images(self, rerun=False, max_cloud_coverage=0.1, threshold=None):
         """
@@ -308,9 +430,7 @@ class timeseries(object):
 
         self.cloud_coverage = np.asarray([self._get_coverage(mask) for mask in self.cloud_masks])
 
-        for index in range(0, len(self.mask)):
-            if self.cloud_coverage[index] > max_cloud_coverage:
-                self.mask[index] = 1
+        self.mask[self.cloud_coverage > max_cloud_coverage] = 1
 
     def mask_invalid_images(self, max_invalid_coverage=0.1):
         """
@@ -329,44 +449,81 @@ class timeseries(object):
 
         self.invalid_coverage = coverage_preview
 
-        for index in range(0, len(self.mask)):
-            if self.invalid_coverage[index] > max_invalid_coverage:
-                self.mask[index] = 1
+        self.mask[self.invalid_coverage > max_invalid_coverage] = 1
+
+    def select_best_frames(self, window='month', months=None):
+        """
+        Keeps only the best-ranked unmasked acquisition of each time window and marks the others. Acquisitions are
+        ranked by cloud coverage plus invalid area coverage, so run it after ``mask_invalid_images`` and
+        ``mask_cloudy_images``, and before downloading full res images.
+
+        :param window: time window, 'week', 'month', 'season', 'year' or '<N>d' (e.g. '10d')
+        :type window: str
+        :param months: months (1-12) to keep, all if None
+        :type months: list of ints or None
+        """
+        scores = np.zeros(len(self.dates))
+        if self.cloud_coverage is not None:
+            scores += self.cloud_coverage
+        if self.invalid_coverage is not None:
+            scores += self.invalid_coverage
+
+        candidates = (self.mask == 0) & calendar_filter(self.dates64, months=months)
+
+        keep = select_best_per_window(window_index(self.dates64, window), scores, candidates)
+        self.mask[~keep] = 1
+
+        LOGGER.info('%d acquisitions selected, one per %s.', np.count_nonzero(keep), window)
 
     def mask_images(self, idx):
         """
         Manually mask images with given indexes.
         """
-        for index in idx:
-            self.mask[index] = 1
+        self.mask[np.asarray(idx, dtype=int)] = 1
 
     def unmask_images(self, idx):
         """
         Manually unmask images with given indexes.
         """
-        for index in idx:
-            self.mask[index] = 0
+        self.mask[np.asarray(idx, dtype=int)] = 0
+
+    def mask_dates(self, months=None, seasons=None, years=None):
+        """
+        Marks images acquired outside the given months, seasons and years.
+
+        :param months: months (1-12) to keep, all if None
+        :type months: list of ints or None
+        :param seasons: seasons to keep, e.g. ['JJA', 'SON'], all if None
+        :type seasons: list of str or None
+        :param years: years to keep, all if None
+        :type years: list of ints or None
+        """
+        self.mask[~calendar_filter(self.dates64, months=months, seasons=seasons, years=years)] = 1
 
     def create_date_stamps(self):
         """
         Create date stamps to be included to gif.
         """
-        filtered = list(compress(self.dates, list(np.logical_not(self.mask))))
+        with folder_lock(datestamps_dir):
+            filtered = self._get_unmasked_dates()
 
-        if not os.path.exists(datestamps_dir):
-            os.makedirs(datestamps_dir)
+            if not os.path.exists(datestamps_dir):
+                os.makedirs(datestamps_dir)
 
-        for date in filtered:
-            datefile = os.path.join(datestamps_dir, date.strftime("%Y-%m-%d") + '.png')
-            if not os.path.isfile(datefile):
-                TimestampUtil.create_date_stamp(date, filtered[0], filtered[-1], datefile)
+            for date in filtered:
+                datefile = os.path.join(datestamps_dir, date.strftime("%Y-%m-%d") + '.png')
+                if not os.path.isfile(datefile):
+                    TimestampUtil.create_date_stamp(date, filtered[0], filtered[-1], datefile)
 
-    def create_timelapse(self, scale_factor=0.3):
+    def create_timelapse(self, scale_factor=0.3, harmonize=False):
         """
         Adds date stamps to full res images and stores them in timelapse subdirectory.
-        """
-        filtered = list(compress(self.dates, list(np.logical_not(self.mask))))
 
+        :param scale_factor: width of the date stamp relative to the frame width
+        :type scale_factor: float
+        :param harmonize: whether to apply the lookup tables of ``compute_harmonisation_luts`` to the frames
+        :type harmonize: bool
+        """
         if not os.path.exists(self.project_name + '/timelapse'):
             os.makedirs(self.project_name + '/timelapse')
 
@@ -375,13 +532,20 @@ class timeseries(object):
                                          self.project_name + '/timelapse/' + date.strftime(
                                              "%Y-%m-%dT%H-%M-%S") + '.png',
                                          self._get_filename(datestamps_dir, date.strftime("%Y-%m-%d")),
-                                         scale_factor=scale_factor) for date in filtered]
+                                         scale_factor=scale_factor, lut=lut)
+            for date, lut in zip(self._get_unmasked_dates(), self._get_unmasked_luts(harmonize))]
 
     def get_coverage(self, cloud_masks=None):
         if cloud_masks is None:
             cloud_masks = self.cloud_masks
         self.cloud_coverage = np.asarray([self._get_coverage(mask) for mask in cloud_masks])
 
+    def _get_unmasked_dates(self):
+        """
+        Returns datetime instances of images not marked in ``self.mask``.
+        """
+        return list(np.asarray(self.dates, dtype=object)[self.mask == 0])
+
     @staticmethod
     def _get_coverage(mask):
         coverage_pixels = np.count_nonzero(mask)
@@ -399,8 +563,7 @@ class timeseries(object):
         :return: datetime instance
         :rtype: datetime
         """
-        chunks = list(map(int, date.split('T')[0].split('-')))
-        return datetime(chunks[0], chunks[1], chunks[2])
+        return to_datetime64(date.split('T')[0]).item()
 
     @staticmethod
     def _datetime_to_iso(date, only_date=True):
@@ -439,9 +602,6 @@ class timeseries(object):
                 return filename
         return None
 
-    def _get_timelapse_files(self, subdir='timelapse'):
-        return sorted(glob.glob(self.project_name + '/' + subdir + '/*png'))
-
     def _get_timelapse_images(self):
         if self.timelapse is None:
             data = np.array(self.fullres_request.get_data())[:, :, :, :-1]
@@ -456,6 +616,7 @@ class timeseries(object):
         :param is_color:
         :type is_color: bool
         """
+        import cv2
 
         images = np.array([image[:, :, [2, 1, 0]] for image in self._get_timelapse_images()])
         self.full_size = (int(images.shape[2]), int(images.shape[1]))
@@ -479,6 +640,8 @@ class timeseries(object):
         :param is_color:
         :type is_color: bool
         """
+        import cv2
+
         video_fullname = os.path.join(self.project_name, video_name)
 
         images = self._get_timelapse_files()  # [img for img in os.listdir(image_folder) if img.endswith(".png")]
@@ -499,6 +662,8 @@ class timeseries(object):
         :param fps: frames per second
         :type fps: int
         """
+        import imageio
+
         with imageio.get_writer(os.path.join(self.project_name, filename), mode='I', fps=fps) as writer:
             for filename in self._get_timelapse_files():
                 image = imageio.imread(filename)
@@ -512,9 +677,13 @@ class TimestampUtil:
 
     @staticmethod
     def add_date_stamp(input_image_path, output_image_path, watermark_image_path,
-                       scale_factor=0.3, minsize=1000):
+                       scale_factor=0.3, minsize=1000, lut=None):
+        from PIL import Image
 
         base_image = Image.open(input_image_path)
+        if lut is not None:
+            # harmonised before resizing, on the fewest pixels
+            base_image = Image.fromarray(apply_lut(np.array(base_image), lut))
         w, h = base_image.size
         if w < minsize:
             scale = minsize / w
@@ -532,12 +701,15 @@ class TimestampUtil:
         transparent = Image.new('RGBA', (width, height), (0, 0, 0, 0))
         transparent.paste(base_image, (0, 0))
         transparent.paste(watermark, (width - int(scale * w_width), 0), mask=watermark)
-        transparent.save(output_image_path)
+        with atomic_path(output_image_path) as tmp_path:
+            transparent.save(tmp_path)
         # Convert RGBA to RGB and return as numpy
         return np.array(transparent.convert('RGB').getdata()).reshape(height, width, 3).astype(np.uint8)
 
     @staticmethod
     def create_date_stamp(current_dt, start_dt, end_dt, filename):
+        import matplotlib.pyplot as plt
+
         years = TimestampUtil._get_years_in_range(start_dt, end_dt)
         equal_year_size = [1] * len(years)
 
@@ -573,7 +745,9 @@ class TimestampUtil:
         ax.text(1.3, 0.8, str(current_dt.year), fontsize=100, color=sh_colors['light'], weight='medium')
         ax.text(2., -0.3, current_dt.strftime('%b'), fontsize=100, color=sh_colors['light'], weight='medium')
 
-        fig.savefig(filename, transparent=True, dpi=300, )
+        # stamps are shared between projects, readers must not see partial files
+        with atomic_path(filename) as tmp_filename:
+            fig.savefig(tmp_filename, transparent=True, dpi=300, )
         plt.close()
 
     @staticmethod
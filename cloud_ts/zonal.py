@@ -0,0 +1,141 @@
+"""
+Zonal statistics of custom-band cubes over a water-body polygon.
+"""
+
+import re
+import warnings
+
+import numpy as np
+
+
+class ZonalStats(object):
+    """
+    Streaming zonal statistics over a polygon for cubes of shape ``(n_dates, height, width, n_bands)``.
+
+    The polygon is rasterised once on the grid of the cube. Each chunk of dates is then reduced in one vectorised
+    pass to per-date band means and percentiles and to the water area given by a normalized difference water index,
+    all computed over clear pixels only.
+    """
+
+    def __init__(self, geometry, bbox, shape, band_names, percentiles=(10, 50, 90), water_bands=('B02', 'B11'),
+                 water_threshold=0.0, pixel_area=None):
+        """
+        :param geometry: polygon of the zone, in the CRS of ``bbox``
+        :type geometry: shapely geometry or str (WKT)
+        :param bbox: bounding box of the cube
+        :type bbox: sentinelhub.BBox or list of floats [minx, miny, maxx, maxy]
+        :param shape: (height, width) of the cube
+        :type shape: tuple of ints
+        :param band_names: names of the cube bands, e.g. ``['B01', 'B02', ...]``
+        :type band_names: list of str
+        :param percentiles: percentiles computed for each band, 0 <= q <= 100
+        :type percentiles: tuple of floats
+        :param water_bands: bands (a, b) of the water index (a - b) / (a + b); the default custom script has no B03,
+            so blue is used in place of green in a MNDWI-like index
+        :type water_bands: tuple of str
+        :param water_threshold: pixels with a water index above this value are counted as water
+        :type water_threshold: float
+        :param pixel_area: area of one pixel in m2, approximated from a WGS84 ``bbox`` if None
+        :type pixel_area: float or None
+        """
+        self.band_names = list(band_names)
+        self.percentiles = tuple(percentiles)
+        self.water_threshold = water_threshold
+        self.water_index = tuple(self.band_names.index(band) for band in water_bands)
+        self.pixel_area = pixel_area if pixel_area is not None else self.get_pixel_area(bbox, shape)
+
+        zone = self.rasterize(geometry, bbox, shape)
+        self.rows, self.cols = np.nonzero(zone)
+        self.n_pixels = self.rows.size
+        if not self.n_pixels:
+            raise ValueError('Polygon does not cover any pixel of the cube.')
+
+        self.records = []
+
+    @staticmethod
+    def rasterize(geometry, bbox, shape):
+        """
+        Returns a boolean mask of shape ``shape`` which is True for pixels whose center falls inside ``geometry``.
+        """
+        from matplotlib.path import Path
+
+        if isinstance(geometry, str):
+            from shapely.wkt import loads
+            geometry = loads(geometry)
+
+        height, width = shape
+        minx, miny, maxx, maxy = [float(x) for x in list(bbox)]
+        xs = minx + (np.arange(width) + 0.5) * (maxx - minx) / width
+        ys = maxy - (np.arange(height) + 0.5) * (maxy - miny) / height
+        xx, yy = np.meshgrid(xs, ys)
+        points = np.column_stack((xx.ravel(), yy.ravel()))
+
+        zone = np.zeros(points.shape[0], dtype=bool)
+        for polygon in getattr(geometry, 'geoms', [geometry]):
+            inside = Path(np.asarray(polygon.exterior.coords)).contains_points(points)
+            for interior in polygon.interiors:
+                inside &= ~Path(np.asarray(interior.coords)).contains_points(points)
+            zone |= inside
+        return zone.reshape(shape)
+
+    @staticmethod
+    def get_pixel_area(bbox, shape):
+        """
+        Approximates the pixel area in m2 of a WGS84 grid from the latitude of the bbox center.
+        """
+        minx, miny, maxx, maxy = [float(x) for x in list(bbox)]
+        lat = np.radians(0.5 * (miny + maxy))
+        width_m = (maxx - minx) * 111320. * np.cos(lat)
+        height_m = (maxy - miny) * 110540.
+        return width_m * height_m / (shape[0] * shape[1])
+
+    def update(self, dates, cube, cloud_masks=None):
+        """
+        Reduces one chunk of dates and appends the result to the table.
+
+        :param dates: dates of the chunk
+        :type dates: list of datetime.datetime
+        :param cube: reflectance of shape ``(n_dates, height, width, n_bands)``
+        :type cube: numpy.ndarray
+        :param cloud_masks: cloud masks of shape ``(n_dates, height, width)``, non-zero where cloudy
+        :type cloud_masks: numpy.ndarray or None
+        """
+        values = cube[:, self.rows, self.cols, :].astype(np.float32, copy=False)
+        clear = np.all(np.isfinite(values) & (values > 0), axis=-1)
+        if cloud_masks is not None:
+            clear &= cloud_masks[:, self.rows, self.cols] == 0
+
+        n_clear = clear.sum(axis=1)
+        masked = np.where(clear[..., np.newaxis], values, np.nan)
+        with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+            # dates without any clear pixel give NaN statistics
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            means = np.nanmean(masked, axis=1)
+            percentiles = np.nanpercentile(masked, self.percentiles, axis=1)
+
+            band_a, band_b = values[..., self.water_index[0]], values[..., self.water_index[1]]
+            index = (band_a - band_b) / (band_a + band_b)
+        water = (index > self.water_threshold) & clear
+
+        for idate, date in enumerate(dates):
+            self.records.append((date, 'zone', 'clear_fraction', n_clear[idate] / float(self.n_pixels)))
+            self.records.append((date, 'water', 'area_m2', np.count_nonzero(water[idate]) * self.pixel_area))
+            for iband, band in enumerate(self.band_names):
+                self.records.append((date, band, 'mean', means[idate, iband]))
+                for iq, q in enumerate(self.percentiles):
+                    self.records.append((date, band, 'p{:g}'.format(q), percentiles[iq, idate, iband]))
+
+    def to_dataframe(self):
+        """
+        Returns the statistics as a tidy table with columns date, band, statistic, value.
+        """
+        import pandas as pd
+
+        return pd.DataFrame.from_records(self.records, columns=['date', 'band', 'statistic', 'value'])
+
+    @staticmethod
+    def parse_band_names(custom_script):
+        """
+        Returns the band names returned by a custom evalscript such as ``return [B01,B02,B04]``.
+        """
+        return re.findall(r'\bB\d[0-9A]\b', custom_script.split('return')[-1])
@@ -0,0 +1,5 @@
+import sys
+
+from sattimelapse.cli import main
+
+sys.exit(main())
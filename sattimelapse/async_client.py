@@ -0,0 +1,240 @@
+"""
+Asyncio download layer for Sentinel Hub OGC (WMS/WCS) requests.
+
+Responses are fetched over a pool of keep-alive connections with a concurrency limit that adapts to throttling
+(429/503) responses, jittered exponential retries of other server and connection errors and a journal of completed
+downloads, so an interrupted run resumes where it stopped. Other 4xx responses fail at once. Files are written where
+sentinelhub expects them, ``request.get_data(save_data=True)`` then reads them from disk.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import os
+import random
+import time
+
+from sattimelapse.locking import atomic_path
+
+LOGGER = logging.getLogger(__name__)
+
+THROTTLE_STATUS = (429, 503)
+
+
+class AdaptiveLimiter(object):
+    """
+    Concurrency limit with additive increase on success and multiplicative decrease on throttling. A
+    ``Retry-After`` header pauses all new requests until the given time.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=16):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.active = 0
+        self.paused_until = 0.
+        self._successes = 0
+        self._condition = None
+
+    async def acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def release(self):
+        async with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def success(self):
+        self._successes += 1
+        if self._successes >= self.limit and self.limit < self.maximum:
+            self.limit += 1
+            self._successes = 0
+
+    def throttle(self, retry_after=None):
+        self.limit = max(self.minimum, self.limit // 2)
+        self._successes = 0
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+        LOGGER.info('Throttled by the server, concurrency limit set to %d.', self.limit)
+
+
+class DownloadJournal(object):
+    """
+    Append-only JSON lines record of completed downloads and of their sizes, so that truncated or replaced files are
+    downloaded again.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.done = {}
+
+        if filename and os.path.isfile(filename):
+            with open(filename) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self.done[entry['url']] = entry['size']
+                    except (ValueError, KeyError):
+                        # last line of an interrupted run may be incomplete
+                        continue
+
+    def is_done(self, url, file_path):
+        try:
+            return self.done.get(url) == os.path.getsize(file_path)
+        except OSError:
+            return False
+
+    def record(self, url, file_path, size):
+        self.done[url] = size
+        if not self.filename:
+            return
+        with open(self.filename, 'a') as fp:
+            fp.write(json.dumps({'url': url, 'file': file_path, 'size': size}) + '\n')
+
+    def forget(self, urls):
+        for url in urls:
+            self.done.pop(url, None)
+
+
+class AsyncDownloader(object):
+    """
+    Downloads lists of ``(url, file_path)`` with asyncio and aiohttp.
+    """
+
+    def __init__(self, initial_concurrency=4, max_concurrency=16, max_retries=5, backoff=1., timeout=300.,
+                 journal_filename=None, headers=None):
+        """
+        :param initial_concurrency: number of simultaneous requests at start
+        :type initial_concurrency: int
+        :param max_concurrency: upper bound of simultaneous requests and size of the connection pool
+        :type max_concurrency: int
+        :param max_retries: number of retries of a failed request
+        :type max_retries: int
+        :param backoff: base delay in seconds of the exponential backoff, randomised by +/- 50 %
+        :type backoff: float
+        :param timeout: total timeout in seconds of one request
+        :type timeout: float
+        :param journal_filename: file recording completed downloads, None to disable resuming
+        :type journal_filename: str or None
+        :param headers: HTTP headers sent with each request
+        :type headers: dict or None
+        """
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.journal = DownloadJournal(journal_filename)
+        self.headers = headers or {}
+
+    def download(self, items):
+        """
+        Downloads all ``(url, file_path)`` items which are not done yet and returns the paths which failed. Called
+        from a running event loop (e.g. Jupyter), the downloads run in a thread with their own loop, coroutines
+        should await ``download_async`` instead.
+        """
+        items = self._get_pending(items)
+        if not items:
+            return []
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self._download_all(items))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self._download_all(items)).result()
+
+    async def download_async(self, items):
+        """
+        Same as ``download``, in the running event loop.
+        """
+        items = self._get_pending(items)
+        if not items:
+            return []
+        return await self._download_all(items)
+
+    def prefetch(self, request, data_filter=None, redownload=False):
+        """
+        Downloads responses of a sentinelhub request into its data folder.
+
+        :param request: sentinelhub request (WmsRequest, WcsRequest)
+        :param data_filter: indices of the dates to download, all if None
+        :type data_filter: list of int or None
+        :param redownload: whether to download responses already on disk
+        :type redownload: bool
+        """
+        download_list = request.get_download_list()
+        if data_filter is not None:
+            download_list = [download_list[index] for index in data_filter]
+
+        items = [(download_request.url, download_request.get_file_path()) for download_request in download_list
+                 if download_request.url and (redownload or not os.path.isfile(download_request.get_file_path()))]
+        if redownload:
+            self.journal.forget(url for url, _ in items)
+
+        failed = self.download(items)
+        if failed:
+            LOGGER.warning('%d downloads failed, they will be requested again by sentinelhub.', len(failed))
+
+    def _get_pending(self, items):
+        return [(url, file_path) for url, file_path in items if not self.journal.is_done(url, file_path)]
+
+    async def _download_all(self, items):
+        import aiohttp
+
+        limiter = AdaptiveLimiter(initial=self.initial_concurrency, maximum=self.max_concurrency)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=self.headers) as session:
+            results = await asyncio.gather(*[self._fetch(session, limiter, url, file_path)
+                                             for url, file_path in items])
+        return [file_path for (_, file_path), ok in zip(items, results) if not ok]
+
+    async def _fetch(self, session, limiter, url, file_path):
+        import aiohttp
+
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire()
+            try:
+                async with session.get(url) as response:
+                    if response.status in THROTTLE_STATUS:
+                        limiter.throttle(self._retry_after(response))
+                    elif 400 <= response.status < 500:
+                        # bad parameters, credentials or missing layer: retrying does not help
+                        LOGGER.warning('Download of %s failed with status %d.', url, response.status)
+                        return False
+                    else:
+                        response.raise_for_status()
+                        content = await response.read()
+                        with atomic_path(file_path) as tmp_path, open(tmp_path, 'wb') as fp:
+                            fp.write(content)
+                        self.journal.record(url, file_path, len(content))
+                        limiter.success()
+                        return True
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exception:
+                LOGGER.debug('Download of %s failed: %s', url, exception)
+            finally:
+                await limiter.release()
+
+            if attempt < self.max_retries:
+                await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        LOGGER.warning('Giving up %s after %d attempts.', url, self.max_retries + 1)
+        return False
+
+    @staticmethod
+    def _retry_after(response):
+        try:
+            return float(response.headers.get('Retry-After', 0))
+        except ValueError:
+            return None
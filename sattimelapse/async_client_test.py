@@ -0,0 +1,165 @@
+"""
+Checks of the asyncio download layer against a local stand-in for the Sentinel Hub OGC services: throttling with
+Retry-After, failing fast on permanent errors, resuming from the download journal and calls from a running event
+loop.
+
+Run with ``python -m sattimelapse.async_client_test`` (or collected by pytest).
+"""
+
+import asyncio
+import collections
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from aiohttp import web
+
+from sattimelapse.async_client import AsyncDownloader
+
+
+class StandInServer(object):
+    """
+    Local HTTP server answering ``/<name>`` with the scripted ``(status, headers)`` of ``script[name]`` one by one,
+    then with ``200`` and the body ``tile <name>``. Requests are counted per name in ``hits``.
+    """
+
+    def __init__(self, script=None):
+        self.script = {name: list(responses) for name, responses in (script or {}).items()}
+        self.hits = collections.Counter()
+        self.port = None
+        self._loop = None
+        self._runner = None
+        self._thread = None
+
+    def url(self, name):
+        return 'http://127.0.0.1:{}/{}'.format(self.port, name)
+
+    async def handle(self, request):
+        name = request.match_info['name']
+        self.hits[name] += 1
+        if self.script.get(name):
+            status, headers = self.script[name].pop(0)
+            return web.Response(status=status, headers=headers)
+        return web.Response(body='tile {}'.format(name).encode())
+
+    def start(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        self.port = sock.getsockname()[1]
+        ready = threading.Event()
+
+        async def serve():
+            app = web.Application()
+            app.router.add_get('/{name}', self.handle)
+            self._runner = web.AppRunner(app)
+            await self._runner.setup()
+            await web.SockSite(self._runner, sock).start()
+            ready.set()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            self._loop.run_until_complete(serve())
+            self._loop.run_forever()
+            self._loop.run_until_complete(self._runner.cleanup())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def get_downloader(folder, **kwargs):
+    return AsyncDownloader(backoff=0.01, journal_filename=os.path.join(folder, 'journal.jsonl'), **kwargs)
+
+
+def test_throttling():
+    folder = tempfile.mkdtemp()
+    try:
+        script = {'a': [(429, {'Retry-After': '0.1'}), (503, {})]}
+        with StandInServer(script) as server:
+            file_path = os.path.join(folder, 'a.png')
+            assert get_downloader(folder).download([(server.url('a'), file_path)]) == []
+            assert server.hits['a'] == 3
+            with open(file_path, 'rb') as fp:
+                assert fp.read() == b'tile a'
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_permanent_error_fails_fast():
+    folder = tempfile.mkdtemp()
+    try:
+        with StandInServer({'missing': [(404, {})] * 10}) as server:
+            file_path = os.path.join(folder, 'missing.png')
+            assert get_downloader(folder).download([(server.url('missing'), file_path)]) == [file_path]
+            assert server.hits['missing'] == 1
+            assert not os.path.exists(file_path)
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_resume_and_journal_skip():
+    folder = tempfile.mkdtemp()
+    try:
+        # 'b' keeps failing during the first run, which then gives up on it
+        with StandInServer({'b': [(500, {})] * 2}) as server:
+            items = [(server.url(name), os.path.join(folder, name + '.png')) for name in ('a', 'b')]
+            assert get_downloader(folder, max_retries=1).download(items) == [items[1][1]]
+
+            # a new run reads the journal and only requests 'b'
+            assert get_downloader(folder).download(items) == []
+            assert server.hits == {'a': 1, 'b': 3}
+
+            # everything is journaled, nothing is requested
+            assert get_downloader(folder).download(items) == []
+            assert server.hits == {'a': 1, 'b': 3}
+
+            # journaled but deleted files are downloaded again
+            os.remove(items[0][1])
+            assert get_downloader(folder).download(items) == []
+            assert server.hits == {'a': 2, 'b': 3}
+
+            # so are files whose size differs from the journaled one, e.g. truncated
+            with open(items[1][1], 'wb') as fp:
+                fp.write(b'tile')
+            assert get_downloader(folder).download(items) == []
+            assert server.hits == {'a': 2, 'b': 4}
+    finally:
+        shutil.rmtree(folder)
+
+
+def test_running_event_loop():
+    folder = tempfile.mkdtemp()
+    try:
+        with StandInServer() as server:
+            items = [(server.url(name), os.path.join(folder, name + '.png')) for name in ('a', 'b')]
+
+            async def run():
+                # as from a notebook cell: the blocking call must not start a second loop in this thread
+                assert get_downloader(folder).download(items[:1]) == []
+                assert await get_downloader(folder).download_async(items) == []
+
+            asyncio.run(run())
+            assert server.hits == {'a': 1, 'b': 1}
+    finally:
+        shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    for test in (test_throttling, test_permanent_error_fails_fast, test_resume_and_journal_skip,
+                 test_running_event_loop):
+        test()
+        print('{} ok'.format(test.__name__))
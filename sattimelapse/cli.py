@@ -0,0 +1,214 @@
+"""
+Command line interface, ``python -m sattimelapse <command>``.
+
+Commands map to the stages of ``sattimelapse.pipeline.timelapse_pipeline``: ``fetch`` downloads previews and cloud
+data, ``mask`` selects the frames, ``render`` writes the stamped frames and ``encode`` the video. Stages already
+done with the same parameters are skipped. ``plan`` and ``status`` do not download images and heavy libraries are
+imported by the stages which use them, so quick commands start fast.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+STAGE_COMMANDS = {'fetch': 'cloud data', 'mask': 'masks', 'render': 'frames', 'encode': 'video'}
+
+
+def get_bbox(args):
+    """
+    Returns the WGS84 bbox of ``--bbox`` or of the inflated polygon of ``--wkt`` (converted from the shapefile next
+    to it if needed).
+    """
+    from sentinelhub import BBox, CRS
+    from sattimelapse.sites import bbox_creator, shp2wkt
+
+    if args.bbox is not None:
+        return BBox(bbox=args.bbox, crs=CRS.WGS84)
+    if args.wkt is None:
+        raise SystemExit('Either --bbox or --wkt is required.')
+    if not os.path.isfile(args.wkt):
+        shp2wkt(args.wkt.replace('wkt', 'shp'))
+    return bbox_creator(args.wkt, args.inflate)
+
+
+def get_request_kwargs(bbox):
+    """
+    Returns resolutions and request type planned from the bbox size and the target frame size.
+    """
+    from sattimelapse.planner import plan_request
+    from sattimelapse.sites import get_bbox_size
+
+    request_kwargs, products = plan_request(get_bbox_size(bbox), target_size=(1920, 1080))
+    print('Planned products: {}'.format(products))
+    return request_kwargs
+
+
+def plan(args):
+    from sattimelapse.config import get_instance_id
+    from sattimelapse.estimate import get_catalogue_dates, get_catalogue_filename, estimate_run, suggest_settings, \
+        format_report
+    from sattimelapse.sites import get_bbox_size
+
+    bbox = get_bbox(args)
+    request_kwargs = get_request_kwargs(bbox)
+    dates = get_catalogue_dates(bbox, [args.start, args.end], instance_id=get_instance_id(args.instance_id),
+                                cache_file=get_catalogue_filename(args.project))
+    print(format_report(estimate_run(get_bbox_size(bbox), len(dates), **request_kwargs)))
+
+    if args.budget_ram is not None:
+        budget = {'peak_ram_bytes': args.budget_ram}
+        suggestion = suggest_settings(get_bbox_size(bbox), len(dates), budget, **request_kwargs)
+        if suggestion is None:
+            print('No setting fits the budget {}, consider a shorter time interval.'.format(budget))
+        else:
+            print('Suggested settings within budget: {}'.format(suggestion[0]))
+
+
+def status(args):
+    """
+    Prints the cached catalogue and the stages done, from the project files only.
+    """
+    from sattimelapse.estimate import get_catalogue_filename, read_catalogue
+
+    dates = read_catalogue(get_catalogue_filename(args.project))
+    if dates is not None:
+        print('{} dates from {} to {}'.format(len(dates), dates[0], dates[-1]) if dates else 'No dates')
+        if args.dates:
+            print('\n'.join(str(date) for date in dates))
+    else:
+        print('No catalogue yet, run plan or fetch first.')
+
+    manifest_file = os.path.join(args.project, 'pipeline.json')
+    manifest = {}
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as fp:
+            manifest = json.load(fp)
+    for name, entry in sorted(manifest.items(), key=lambda item: item[1]['finished']):
+        print('{:12} done {}'.format(name, entry['finished']))
+
+
+def run_stages(args):
+    """
+    Runs the pipeline of one project up to the stage of the command.
+    """
+    from sattimelapse.config import get_instance_id
+    from sattimelapse.pipeline import timelapse_pipeline
+    from sattimelapse.time_lapse import SentinelHubTimelapse
+
+    bbox = get_bbox(args)
+    request_kwargs = get_request_kwargs(bbox)
+    time_interval = [args.start, args.end]
+    timelapse = SentinelHubTimelapse(args.project, bbox, time_interval, instance_id=get_instance_id(args.instance_id),
+                                     **request_kwargs)
+    pipeline = timelapse_pipeline(timelapse, request_params=dict(request_kwargs, bbox=bbox,
+                                                                 time_interval=time_interval),
+                                  max_cc=args.max_cc, mask_images=args.mask_images,
+                                  quality_checks=args.quality_checks, max_hash_distance=args.max_hash_distance,
+                                  select_window=args.select_window, select_months=args.select_months,
+                                  scale_factor=args.scale_factor,
+                                  harmonize=args.harmonize, fps=args.fps)
+    ran = pipeline.run(force=args.force, until=STAGE_COMMANDS.get(args.command))
+    print('{}: ran {}'.format(args.project, ', '.join(ran) if ran else 'nothing, up to date'))
+
+
+def batch(args):
+    """
+    Runs all stages for each site of a JSON lines file, e.g.
+    ``{"project": "/data/lake", "wkt": "/data/lake/shape/lake.wkt", "start": "2017-01-01", "end": "2018-12-31"}``,
+    in parallel processes.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    with open(args.sites) as fp:
+        sites = [json.loads(line) for line in fp if line.strip()]
+
+    jobs = []
+    for site in sites:
+        site_args = argparse.Namespace(**vars(args))
+        site_args.command = 'encode'
+        site_args.bbox = None
+        site_args.wkt = None
+        for key, value in site.items():
+            setattr(site_args, key, value)
+        jobs.append(site_args)
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        for site_args, error in zip(jobs, pool.map(_run_site, jobs)):
+            if error:
+                print('{}: failed, {}'.format(site_args.project, error))
+
+
+def _run_site(args):
+    try:
+        run_stages(args)
+    except Exception as exception:
+        return repr(exception)
+    return None
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog='sattimelapse', description='Sentinel-2 timelapses of water bodies.')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    site = argparse.ArgumentParser(add_help=False)
+    site.add_argument('project', help='project folder')
+    site.add_argument('--wkt', help='WKT file of the nominal water extent')
+    site.add_argument('--bbox', type=float, nargs=4, metavar=('MINX', 'MINY', 'MAXX', 'MAXY'),
+                      help='WGS84 bbox instead of --wkt')
+    site.add_argument('--inflate', type=float, default=0.3, help='bbox inflation around the WKT polygon')
+    site.add_argument('--start', default='2015-05-01')
+    site.add_argument('--end', default=None)
+    site.add_argument('--instance-id', default=None,
+                      help='Sentinel Hub instance ID, else $SH_INSTANCE_ID, myID.txt or the sentinelhub config')
+
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument('--max-cc', type=float, default=0.33, help='maximal cloud coverage of frames')
+    options.add_argument('--mask-images', type=int, nargs='*', default=[], help='indices of dates to mask')
+    options.add_argument('--quality-checks', action='store_true', help='mask hazy, striped or saturated frames')
+    options.add_argument('--max-hash-distance', type=int, default=None, help='mask near-duplicate frames')
+    options.add_argument('--select-window', default=None, help="keep the best frame per 'week', 'month', ...")
+    options.add_argument('--select-months', type=int, nargs='*', default=None,
+                         help='months (1-12) to keep with --select-window')
+    options.add_argument('--scale-factor', type=float, default=.43, help='width of date stamps relative to frames')
+    options.add_argument('--harmonize', action='store_true', help='harmonise the radiometry of frames')
+    options.add_argument('--fps', type=int, default=3)
+    options.add_argument('--force', nargs='*', default=[], help='names of stages to run anyway')
+
+    command = commands.add_parser('plan', parents=[site], help='print request, size and cost estimates')
+    command.add_argument('--budget-ram', type=float, default=None, help='suggest settings within this peak RAM')
+    command.set_defaults(function=plan)
+
+    command = commands.add_parser('status', help='print cached dates and stages done')
+    command.add_argument('project', help='project folder')
+    command.add_argument('--dates', action='store_true', help='list the dates')
+    command.set_defaults(function=status)
+
+    for name, description in [('fetch', 'download previews and cloud data'), ('mask', 'select frames'),
+                       ('render', 'download full res images and write stamped frames'),
+                       ('encode', 'run all stages up to the video')]:
+        command = commands.add_parser(name, parents=[site, options], help=description)
+        command.set_defaults(function=run_stages)
+
+    command = commands.add_parser('batch', parents=[options], help='run all stages for the sites of a file')
+    command.add_argument('sites', help='JSON lines file of sites (project, wkt or bbox, start, end)')
+    command.add_argument('--jobs', type=int, default=2, help='number of sites processed in parallel')
+    command.add_argument('--inflate', type=float, default=0.3)
+    command.add_argument('--start', default='2015-05-01')
+    command.add_argument('--end', default=None)
+    command.add_argument('--instance-id', default=None)
+    command.set_defaults(function=batch)
+    return parser
+
+
+def main(argv=None):
+    args = get_parser().parse_args(argv)
+    if getattr(args, 'end', 1) is None:
+        import datetime
+        args.end = datetime.date.today().isoformat()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+"""
+Streaming per-pixel accumulators for clear-sky frequency and cloud-free temporal composites.
+"""
+
+import numpy as np
+
+SEASONS = {12: 'DJF', 1: 'DJF', 2: 'DJF', 3: 'MAM', 4: 'MAM', 5: 'MAM',
+           6: 'JJA', 7: 'JJA', 8: 'JJA', 9: 'SON', 10: 'SON', 11: 'SON'}
+
+
+class CompositeAccumulator(object):
+    """
+    Accumulates clear observations of uint8 frames one frame at a time.
+
+    Keeps a clear-observation count, running sums and a coarse per-pixel histogram from which an approximate median
+    is interpolated. Memory is O(pixels) and does not grow with the number of frames: with 3 channels and 32 bins,
+    about 110 bytes per pixel, the histogram counts being uint8 until 255 frames were added.
+    """
+
+    def __init__(self, shape, n_channels=3, n_bins=32):
+        """
+        :param shape: (height, width) of the frames
+        :type shape: tuple of ints
+        :param n_channels: number of channels of the frames
+        :type n_channels: int
+        :param n_bins: number of histogram bins over [0, 256), a power of 2 <= 256
+        :type n_bins: int
+        """
+        if n_bins & (n_bins - 1) or not 0 < n_bins <= 256:
+            raise ValueError('n_bins must be a power of 2 not larger than 256.')
+
+        self.shape = tuple(shape)
+        self.n_channels = n_channels
+        self.n_bins = n_bins
+        self.bin_shift = 8 - int(np.log2(n_bins))
+        self.count = np.zeros(self.shape, dtype=np.uint16)
+        self.sums = np.zeros(self.shape + (n_channels,), dtype=np.uint32)
+        self.histogram = np.zeros((n_bins, int(np.prod(self.shape)) * n_channels), dtype=np.uint8)
+        self.n_frames = 0
+
+    def update(self, frame, clear):
+        """
+        Adds the clear pixels of one frame.
+
+        :param frame: image of shape ``(height, width, n_channels)``
+        :type frame: numpy.ndarray of uint8
+        :param clear: True where the pixel is valid and cloud free
+        :type clear: numpy.ndarray of bool
+        """
+        frame = frame[:, :, :self.n_channels]
+        clear = clear.astype(bool, copy=False)
+
+        # a bin count can only reach 255 after 255 frames
+        if self.n_frames == np.iinfo(np.uint8).max:
+            self.histogram = self.histogram.astype(np.uint16)
+        self.n_frames += 1
+
+        self.count += clear
+        self.sums += frame * clear[:, :, np.newaxis]
+
+        # every (pixel, channel) column receives at most one count, so fancy-index increment is safe
+        columns = np.flatnonzero(np.repeat(clear.ravel(), self.n_channels))
+        bins = frame.ravel()[columns] >> self.bin_shift
+        self.histogram[bins, columns] += 1
+
+    def clear_count(self):
+        """
+        Returns the number of clear observations of each pixel.
+        """
+        return self.count
+
+    def mean(self):
+        """
+        Returns the mean composite as uint8, pixels without clear observation are 0.
+        """
+        count = np.maximum(self.count, 1)[:, :, np.newaxis]
+        return (self.sums / count).round().astype(np.uint8)
+
+    def median(self):
+        """
+        Returns the approximate median composite as uint8, interpolated within the median histogram bin. Pixels without
+        clear observation are 0.
+        """
+        half = np.repeat(self.count.ravel(), self.n_channels) / 2.
+        width = 256 // self.n_bins
+        median = np.zeros(half.shape, dtype=np.float32)
+        found = half == 0
+        running = np.zeros(half.shape, dtype=np.uint32)
+
+        for index in range(self.n_bins):
+            counts = self.histogram[index]
+            below = running.copy()
+            running += counts
+            hit = ~found & (running >= half)
+            if hit.any():
+                fraction = (half[hit] - below[hit]) / np.maximum(counts[hit], 1)
+                median[hit] = (index + fraction) * width
+                found |= hit
+            if found.all():
+                break
+
+        return np.clip(median, 0, 255).round().astype(np.uint8).reshape(self.shape + (self.n_channels,))
+
+    def fill(self, frame, clear, composite=None):
+        """
+        Returns a copy of ``frame`` whose non-clear pixels are replaced by the (median) composite.
+        """
+        composite = self.median() if composite is None else composite
+        filled = frame[:, :, :self.n_channels].copy()
+        filled[~clear.astype(bool)] = composite[~clear.astype(bool)]
+        return filled
+
+
+class TemporalComposites(object):
+    """
+    One ``CompositeAccumulator`` per period (calendar month, season, year-month or the whole interval).
+
+    Frames are expected in time order. A year-month period is finished when the first frame of the next one arrives:
+    its mean and median composites are computed and its accumulator dropped, so that at most one accumulator is held
+    whatever the number of months. Calendar months and seasons recur and keep up to 12 and 4 accumulators.
+    """
+
+    PERIODS = ('all', 'month', 'season', 'year-month')
+
+    def __init__(self, shape, period='month', on_finish=None, **kwargs):
+        """
+        :param shape: (height, width) of the frames
+        :type shape: tuple of ints
+        :param period: one of ``PERIODS``
+        :type period: str
+        :param on_finish: function ``on_finish(key, mean, median)`` called with the composites of each finished period,
+            which are then not kept in ``self.finished``
+        :type on_finish: callable or None
+        :param kwargs: parameters of ``CompositeAccumulator``
+        """
+        if period not in self.PERIODS:
+            raise ValueError('period must be one of {}'.format(self.PERIODS))
+
+        self.shape = tuple(shape)
+        self.period = period
+        self.on_finish = on_finish
+        self.kwargs = kwargs
+        self.accumulators = {}
+        # mean and median composites of finished periods
+        self.finished = {}
+        self.finished_keys = set()
+        self.count = np.zeros(self.shape, dtype=np.uint32)
+
+    def period_key(self, date):
+        """
+        Returns the key of the period ``date`` belongs to, e.g. '05' (month), 'MAM' (season), '2017-05'.
+        """
+        if self.period == 'month':
+            return '{:02d}'.format(date.month)
+        if self.period == 'season':
+            return SEASONS[date.month]
+        if self.period == 'year-month':
+            return date.strftime('%Y-%m')
+        return 'all'
+
+    def update(self, date, frame, clear):
+        key = self.period_key(date)
+        if key in self.finished_keys:
+            raise ValueError('Period {} is already finished, frames must be in time order.'.format(key))
+        if self.period == 'year-month':
+            for done in [done for done in self.accumulators if done != key]:
+                self.finish(done)
+
+        if key not in self.accumulators:
+            self.accumulators[key] = CompositeAccumulator(self.shape, **self.kwargs)
+        self.accumulators[key].update(frame, clear)
+        self.count += clear
+
+    def finish(self, key=None):
+        """
+        Computes the composites of period ``key``, or of all periods still accumulated if None, and drops their
+        accumulators.
+
+        :return: mean and median composites of the finished periods which are kept
+        :rtype: dict
+        """
+        for done in list(self.accumulators) if key is None else [key]:
+            accumulator = self.accumulators.pop(done)
+            self.finished_keys.add(done)
+            if self.on_finish is not None:
+                self.on_finish(done, accumulator.mean(), accumulator.median())
+            else:
+                self.finished[done] = {'mean': accumulator.mean(), 'median': accumulator.median()}
+        return self.finished
+
+    def clear_count(self):
+        """
+        Returns the number of clear observations of each pixel over all periods.
+        """
+        return self.count
+
+    @staticmethod
+    def resize_mask(mask, shape):
+        """
+        Nearest-neighbour resize of a 2D mask, e.g. a cloud mask at cloud-mask resolution onto a full-res frame.
+        """
+        rows = np.arange(shape[0]) * mask.shape[0] // shape[0]
+        cols = np.arange(shape[1]) * mask.shape[1] // shape[1]
+        return mask[rows[:, np.newaxis], cols]
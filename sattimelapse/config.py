@@ -0,0 +1,33 @@
+"""
+Lazy resolution of the Sentinel Hub credentials, read only when a request is made.
+"""
+
+import os
+
+INSTANCE_ID_ENV = 'SH_INSTANCE_ID'
+INSTANCE_ID_FILE = 'myID.txt'
+
+_instance_id = None
+
+
+def get_instance_id(instance_id=None):
+    """
+    Returns the Sentinel Hub instance ID: ``instance_id`` if given, else the ``SH_INSTANCE_ID`` environment variable,
+    else the first line of ``myID.txt`` in the working directory, else the one of the sentinelhub configuration.
+    The result is cached.
+    """
+    global _instance_id
+    if instance_id:
+        return instance_id
+    if _instance_id is not None:
+        return _instance_id
+
+    if os.environ.get(INSTANCE_ID_ENV):
+        _instance_id = os.environ[INSTANCE_ID_ENV]
+    elif os.path.isfile(INSTANCE_ID_FILE):
+        with open(INSTANCE_ID_FILE) as f:
+            _instance_id = f.readline().strip()
+    else:
+        from sentinelhub import SHConfig
+        _instance_id = SHConfig().instance_id
+    return _instance_id
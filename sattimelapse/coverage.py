@@ -0,0 +1,146 @@
+"""
+Summed-area tables (integral images) of cloud and validity masks.
+
+Once built, the cloud and invalid coverage of any rectangular sub-window can be
+read for all dates with four lookups per date, without touching the masks again.
+"""
+
+import os
+
+import numpy as np
+
+from sattimelapse.locking import atomic_path
+
+
+class CoverageTable(object):
+    """
+    Per-date integral images of the cloud masks and of the validity (transparency) masks.
+
+    Windows are given as fractions of the frame, ``(x0, y0, x1, y1)`` with ``0 <= x0 < x1 <= 1`` and
+    ``0 <= y0 < y1 <= 1``, measured from the upper-left corner, so that cloud masks and previews of
+    different resolutions can be queried with the same window.
+    """
+
+    FILENAME = 'coverage_tables.npz'
+
+    def __init__(self, cloud_table=None, valid_table=None):
+        self.cloud_table = cloud_table
+        self.valid_table = valid_table
+
+    @classmethod
+    def from_masks(cls, cloud_masks=None, valid_masks=None):
+        """
+        Builds the integral images from stacks of masks of shape ``(n_dates, height, width)``.
+
+        :param cloud_masks: stack of cloud masks, non-zero where cloudy
+        :type cloud_masks: numpy.ndarray or None
+        :param valid_masks: stack of validity masks, non-zero where data is valid (e.g. alpha band)
+        :type valid_masks: numpy.ndarray or None
+        :return: coverage table
+        :rtype: CoverageTable
+        """
+        return cls(cloud_table=cls.integral_image(cloud_masks), valid_table=cls.integral_image(valid_masks))
+
+    @staticmethod
+    def integral_image(masks):
+        """
+        Returns the zero-padded summed-area table of a mask stack, of shape ``(n_dates, height + 1, width + 1)``.
+        """
+        if masks is None:
+            return None
+        masks = np.asarray(masks)
+        table = np.zeros((masks.shape[0], masks.shape[1] + 1, masks.shape[2] + 1), dtype=np.int64)
+        np.cumsum(masks != 0, axis=1, dtype=np.int64, out=table[:, 1:, 1:])
+        np.cumsum(table[:, 1:, 1:], axis=2, out=table[:, 1:, 1:])
+        dtype = np.uint32 if table[:, -1, -1].max(initial=0) < 2 ** 32 else np.int64
+        return table.astype(dtype, copy=False)
+
+    @staticmethod
+    def window_sum(table, window=None):
+        """
+        Returns the number of non-zero pixels and the number of pixels within ``window`` for each date.
+
+        :param table: summed-area table as returned by ``integral_image``
+        :type table: numpy.ndarray
+        :param window: relative window ``(x0, y0, x1, y1)``, whole frame if None
+        :type window: tuple of floats or None
+        :return: counts of non-zero pixels per date, number of pixels in the window
+        :rtype: numpy.ndarray, int
+        """
+        height, width = table.shape[1] - 1, table.shape[2] - 1
+        x0, y0, x1, y1 = CoverageTable._to_pixels(window, width, height)
+        table = table.astype(np.int64, copy=False)
+        counts = table[:, y1, x1] - table[:, y0, x1] - table[:, y1, x0] + table[:, y0, x0]
+        return counts, (x1 - x0) * (y1 - y0)
+
+    def cloud_coverage(self, window=None):
+        """
+        Returns the cloud coverage of ``window`` for all dates, 0 <= cc <= 1.
+        """
+        counts, size = self.window_sum(self.cloud_table, window)
+        return counts / float(size)
+
+    def invalid_coverage(self, window=None):
+        """
+        Returns the invalid area coverage of ``window`` for all dates, 0 <= ic <= 1.
+        """
+        counts, size = self.window_sum(self.valid_table, window)
+        return 1.0 - counts / float(size)
+
+    def save(self, folder):
+        """
+        Saves the tables to ``folder``, typically next to ``cloudmasks.npy``.
+        """
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+        tables = {name: table for name, table in (('cloud', self.cloud_table), ('valid', self.valid_table))
+                  if table is not None}
+        with atomic_path(os.path.join(folder, self.FILENAME)) as tmp_filename, open(tmp_filename, 'wb') as fp:
+            np.savez(fp, **tables)
+
+    @classmethod
+    def load(cls, folder):
+        """
+        Loads the tables from ``folder``, returns None if they were not saved yet.
+        """
+        filename = os.path.join(folder, cls.FILENAME)
+        if not os.path.isfile(filename):
+            return None
+
+        with np.load(filename) as data:
+            return cls(cloud_table=data['cloud'] if 'cloud' in data else None,
+                       valid_table=data['valid'] if 'valid' in data else None)
+
+    @staticmethod
+    def window_from_bbox(bbox, sub_bbox):
+        """
+        Converts a sub-window given in the coordinates of ``bbox`` into a relative window.
+
+        :param bbox: bounding box of the frames
+        :type bbox: sentinelhub.BBox or list of floats [minx, miny, maxx, maxy]
+        :param sub_bbox: bounding box of the sub-window, same CRS as ``bbox``
+        :type sub_bbox: sentinelhub.BBox or list of floats [minx, miny, maxx, maxy]
+        :return: relative window ``(x0, y0, x1, y1)``
+        :rtype: tuple of floats
+        """
+        minx, miny, maxx, maxy = [float(x) for x in list(bbox)]
+        sminx, sminy, smaxx, smaxy = [float(x) for x in list(sub_bbox)]
+        delx, dely = maxx - minx, maxy - miny
+
+        # image rows run from north to south
+        return ((sminx - minx) / delx, (maxy - smaxy) / dely, (smaxx - minx) / delx, (maxy - sminy) / dely)
+
+    @staticmethod
+    def _to_pixels(window, width, height):
+        if window is None:
+            return 0, 0, width, height
+
+        x0, y0, x1, y1 = window
+        x0 = int(np.clip(np.floor(x0 * width), 0, width))
+        x1 = int(np.clip(np.ceil(x1 * width), 0, width))
+        y0 = int(np.clip(np.floor(y0 * height), 0, height))
+        y1 = int(np.clip(np.ceil(y1 * height), 0, height))
+        if x1 <= x0 or y1 <= y0:
+            raise ValueError('Window {} is empty or outside of the frame.'.format(window))
+        return x0, y0, x1, y1
@@ -0,0 +1,110 @@
+"""
+Vectorised date helpers on ``datetime64`` arrays: calendar filters, window grouping and temporal selection.
+"""
+
+import numpy as np
+
+SEASON_NAMES = ('DJF', 'MAM', 'JJA', 'SON')
+
+
+def to_datetime64(dates):
+    """
+    Returns dates (datetime instances, ISO strings or datetime64) as a ``datetime64[s]`` array.
+    """
+    return np.asarray(dates, dtype='datetime64[s]')
+
+
+def get_years(dates):
+    """
+    Returns the calendar year of each date.
+    """
+    return dates.astype('datetime64[Y]').astype(np.int64) + 1970
+
+
+def get_months(dates):
+    """
+    Returns the month (1-12) of each date.
+    """
+    return dates.astype('datetime64[M]').astype(np.int64) % 12 + 1
+
+
+def get_seasons(dates):
+    """
+    Returns the season index of each date within its year, 0: DJF, 1: MAM, 2: JJA, 3: SON.
+    """
+    return get_months(dates) % 12 // 3
+
+
+def calendar_filter(dates, months=None, seasons=None, years=None):
+    """
+    Returns a boolean array which is True for dates within all the given months, seasons and years.
+
+    :param dates: acquisition dates
+    :type dates: numpy.ndarray of datetime64
+    :param months: months (1-12) to keep, all if None
+    :type months: list of ints or None
+    :param seasons: seasons to keep, e.g. ['JJA', 'SON'], all if None
+    :type seasons: list of str or None
+    :param years: years to keep, all if None
+    :type years: list of ints or None
+    :rtype: numpy.ndarray of bool
+    """
+    keep = np.ones(dates.shape, dtype=bool)
+    if months is not None:
+        keep &= np.isin(get_months(dates), list(months))
+    if seasons is not None:
+        keep &= np.isin(get_seasons(dates), [SEASON_NAMES.index(season) for season in seasons])
+    if years is not None:
+        keep &= np.isin(get_years(dates), list(years))
+    return keep
+
+
+def window_index(dates, window='month'):
+    """
+    Returns an integer key of the time window each date belongs to.
+
+    :param dates: acquisition dates
+    :type dates: numpy.ndarray of datetime64
+    :param window: 'week' (Monday to Sunday), 'month', 'season' (DJF, MAM, JJA, SON; December counts with the
+        following year), 'year', or a number of days ``'<N>d'`` counted from the first date
+    :type window: str
+    :rtype: numpy.ndarray of int64
+    """
+    days = dates.astype('datetime64[D]').astype(np.int64)
+    if window == 'week':
+        # 1970-01-01 is a Thursday
+        return (days + 3) // 7
+    if window == 'month':
+        return dates.astype('datetime64[M]').astype(np.int64)
+    if window == 'season':
+        return (dates.astype('datetime64[M]').astype(np.int64) + 1) // 3
+    if window == 'year':
+        return dates.astype('datetime64[Y]').astype(np.int64)
+    if window.endswith('d'):
+        return (days - days[0]) // int(window[:-1]) if days.size else days
+    raise ValueError("window must be 'week', 'month', 'season', 'year' or '<N>d'")
+
+
+def select_best_per_window(keys, scores, candidates=None):
+    """
+    Returns a boolean array which is True for the best (lowest score) candidate of each window.
+
+    :param keys: window key of each date
+    :type keys: numpy.ndarray of int
+    :param scores: rank of each date, lower is better
+    :type scores: numpy.ndarray
+    :param candidates: dates which may be selected, all if None
+    :type candidates: numpy.ndarray of bool or None
+    :rtype: numpy.ndarray of bool
+    """
+    keys = np.asarray(keys)
+    keep = np.zeros(keys.shape, dtype=bool)
+    indices = np.flatnonzero(candidates) if candidates is not None else np.arange(keys.size)
+    if not indices.size:
+        return keep
+
+    order = indices[np.lexsort((np.asarray(scores)[indices], keys[indices]))]
+    first = np.ones(order.size, dtype=bool)
+    first[1:] = keys[order[1:]] != keys[order[:-1]]
+    keep[order[first]] = True
+    return keep
@@ -0,0 +1,212 @@
+"""
+Dry-run estimates of requests, processing units, bytes, RAM and disk of a timelapse run, from the catalogue only.
+"""
+
+import datetime
+import json
+import os
+
+from sattimelapse.locking import atomic_path
+
+# processing unit: 512 x 512 pixels, 3 bands, 8 bits
+PU_PIXELS = 512 * 512
+PU_MINIMUM = 0.01
+# rough PNG compression ratio of natural colour images
+PNG_RATIO = 0.6
+FULL_RES_LADDER = (10, 20, 30, 60, 120)
+# dates of a project, shared by the dry run, the pipeline and the command line
+CATALOGUE_FILENAME = os.path.join('pipeline', 'catalogue.json')
+
+
+def get_catalogue_dates(bbox, time_interval, instance_id='', layer='TRUE-COLOR-S2-L1C',
+                        time_difference=datetime.timedelta(hours=2), cache_file=None):
+    """
+    Returns the acquisition dates of a site by querying the catalogue only, no image is downloaded. Dates are
+    cached in ``cache_file`` if given, together with the query, and queried again if the query changed.
+    """
+    query = get_catalogue_query(bbox, time_interval, layer, time_difference)
+    if cache_file:
+        dates = read_catalogue(cache_file, query)
+        if dates is not None:
+            return dates
+
+    from sentinelhub.data_request import WmsRequest
+
+    request = WmsRequest(layer=layer, bbox=bbox, time=time_interval, width=1, height=1, maxcc=1.0,
+                         instance_id=instance_id, time_difference=time_difference)
+    dates = request.get_dates()
+
+    if cache_file:
+        write_catalogue(cache_file, dates, query)
+    return dates
+
+
+def get_catalogue_filename(project_name):
+    return os.path.join(project_name, CATALOGUE_FILENAME)
+
+
+def get_catalogue_query(bbox, time_interval, layer, time_difference):
+    """
+    Returns the parameters of a catalogue query as stored with cached dates.
+    """
+    query = {'bbox': str(bbox), 'crs': str(getattr(bbox, 'crs', None)), 'time_interval': list(time_interval),
+             'layer': layer, 'time_difference': time_difference.total_seconds()}
+    # same types as read back from JSON
+    return json.loads(json.dumps(query, default=str))
+
+
+def read_catalogue(filename, query=None):
+    """
+    Returns the dates cached in ``filename``, None if there are none or if they were cached for another query.
+    Any cached dates are returned if ``query`` is None.
+    """
+    if not os.path.isfile(filename):
+        return None
+    with open(filename) as fp:
+        catalogue = json.load(fp)
+    if isinstance(catalogue, list):
+        # earlier caches hold the dates only
+        catalogue = {'query': None, 'dates': catalogue}
+    if query is not None and catalogue.get('query') != query:
+        return None
+    return [datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S') for date in catalogue['dates']]
+
+
+def write_catalogue(filename, dates, query=None):
+    """
+    Writes ``dates`` and the ``query`` they were obtained with to ``filename``.
+    """
+    folder = os.path.dirname(filename)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder)
+    with atomic_path(filename) as tmp_filename, open(tmp_filename, 'w') as fp:
+        json.dump({'query': query, 'dates': [date.strftime('%Y-%m-%dT%H:%M:%S') for date in dates]}, fp,
+                  sort_keys=True)
+
+
+def estimate_run(size_m, n_dates, full_res=('10m', '10m'), preview_res=('60m', '60m'),
+                 cloud_mask_res=('60m', '60m'), full_size=(1920, 1080), preview_size=(455, 256), cloud_mask_size=None,
+                 small_area=True, n_kept=None, minsize=1000, fetch_mode='separate'):
+    """
+    Estimates the cost of each stage of ``make_timelapse``.
+
+    :param size_m: E-W and N-S size of the bbox in meters, as returned by ``get_bbox_size``
+    :type size_m: tuple of floats
+    :param n_dates: number of acquisitions
+    :type n_dates: int
+    :param cloud_mask_size: size of the cloud data of WMS requests, ``preview_size`` if None
+    :type cloud_mask_size: tuple of ints or None
+    :param small_area: whether WCS requests at given resolutions are used, else WMS requests of given sizes
+    :type small_area: bool
+    :param n_kept: number of frames expected in the timelapse, all dates if None
+    :type n_kept: int or None
+    :param minsize: minimal frame width of ``TimestampUtil.add_date_stamp``
+    :type minsize: int
+    :param fetch_mode: ``fetch_mode`` of ``SentinelHubTimelapse``, 'single' derives previews from the full res images
+        and fetches the cloud bands as UINT16, 'separate' requests previews and float32 cloud bands
+    :type fetch_mode: str
+    :return: per-stage estimates and totals
+    :rtype: dict
+    """
+    if small_area:
+        full_shape = _shape(size_m, full_res)
+        preview_shape = _shape(size_m, preview_res)
+        cloud_shape = _shape(size_m, cloud_mask_res)
+    else:
+        full_shape = (full_size[1], full_size[0])
+        preview_shape = (preview_size[1], preview_size[0])
+        cloud_mask_size = preview_size if cloud_mask_size is None else cloud_mask_size
+        cloud_shape = (cloud_mask_size[1], cloud_mask_size[0])
+
+    single = fetch_mode == 'single'
+    n_kept = n_dates if n_kept is None else n_kept
+    stages = {
+        'previews': _stage(n_dates, preview_shape, bands=4, bytes_per_band=1, png=True),
+        'fullres': _stage(n_dates, full_shape, bands=4, bytes_per_band=1, png=True),
+        # MultiOutputFetcher requests UINT16 bands, MODEL_EVALSCRIPT requests float32 bands
+        'cloud_data': _stage(n_dates, cloud_shape, bands=10, bytes_per_band=2 if single else 4, png=False),
+    }
+    if single:
+        # previews are reduced from the full res images, nothing is requested
+        stages['previews'].update(requests=0, processing_units=0., download_bytes=0)
+    # get_data returns a list of arrays which np.asarray copies into one stack
+    stages['previews']['peak_ram_bytes'] = 2 * stages['previews']['raw_bytes']
+    stages['fullres']['peak_ram_bytes'] = 2 * stages['fullres']['raw_bytes']
+    # bands and probabilities as float32 plus masks kept by s2cloudless, and the UINT16 bands they are scaled from
+    cloud_pixels = n_dates * cloud_shape[0] * cloud_shape[1]
+    stages['cloud_data']['peak_ram_bytes'] = cloud_pixels * (10 * 4 + 5) + \
+        (stages['cloud_data']['raw_bytes'] if single else 0)
+
+    scale = max(1., float(minsize) / full_shape[1])
+    frame_pixels = int(full_shape[0] * scale) * int(full_shape[1] * scale)
+    stages['frames'] = {'requests': 0, 'processing_units': 0., 'download_bytes': 0,
+                        'disk_bytes': int(n_kept * frame_pixels * 4 * PNG_RATIO),
+                        'peak_ram_bytes': n_kept * frame_pixels * 3, 'shape': (int(full_shape[0] * scale),
+                                                                               int(full_shape[1] * scale))}
+
+    totals = {key: sum(stage[key] for stage in stages.values())
+              for key in ('requests', 'processing_units', 'download_bytes', 'disk_bytes')}
+    # all arrays of previews, full res data and cloud masks are held by SentinelHubTimelapse at once
+    totals['peak_ram_bytes'] = max(stage['peak_ram_bytes'] for stage in stages.values()) + \
+        stages['previews']['raw_bytes'] + stages['fullres']['raw_bytes']
+    return {'n_dates': n_dates, 'stages': stages, 'totals': totals}
+
+
+def suggest_settings(size_m, n_dates, budget, **kwargs):
+    """
+    Returns the finest full res resolution of ``FULL_RES_LADDER`` whose estimates fit ``budget``.
+
+    :param budget: limits on totals, e.g. ``{'peak_ram_bytes': 8e9, 'processing_units': 5000}``
+    :type budget: dict
+    :param kwargs: other parameters of ``estimate_run``, e.g. ``cloud_mask_size`` and ``fetch_mode``
+    :return: suggested parameters and their estimate, None if nothing fits
+    :rtype: tuple of (dict, dict) or None
+    """
+    candidates = [{'full_res': ('{}m'.format(res), '{}m'.format(res)), 'small_area': True}
+                  for res in FULL_RES_LADDER]
+    candidates.append({'small_area': False})
+
+    for candidate in candidates:
+        params = dict(kwargs, **candidate)
+        estimate = estimate_run(size_m, n_dates, **params)
+        if all(estimate['totals'][key] <= limit for key, limit in budget.items()):
+            return candidate, estimate
+    return None
+
+
+def format_report(estimate):
+    """
+    Returns a human readable table of an estimate.
+    """
+    lines = ['{} dates'.format(estimate['n_dates']),
+             '{:<12s}{:>10s}{:>12s}{:>14s}{:>14s}{:>14s}'.format('stage', 'requests', 'PU', 'download', 'disk',
+                                                                 'peak RAM')]
+    rows = list(estimate['stages'].items()) + [('total', estimate['totals'])]
+    for name, stage in rows:
+        lines.append('{:<12s}{:>10d}{:>12.1f}{:>14s}{:>14s}{:>14s}'.format(
+            name, stage['requests'], stage['processing_units'], _human(stage['download_bytes']),
+            _human(stage['disk_bytes']), _human(stage['peak_ram_bytes'])))
+    return '\n'.join(lines)
+
+
+def _shape(size_m, resolution):
+    return (max(int(round(size_m[1] / float(str(resolution[1]).rstrip('m')))), 1),
+            max(int(round(size_m[0] / float(str(resolution[0]).rstrip('m')))), 1))
+
+
+def _stage(n_requests, shape, bands, bytes_per_band, png):
+    pixels = shape[0] * shape[1]
+    raw_bytes = n_requests * pixels * bands * bytes_per_band
+    download_bytes = int(raw_bytes * PNG_RATIO) if png else raw_bytes
+    # float32 output counts twice, more than 3 bands proportionally
+    pu = max(pixels / float(PU_PIXELS), PU_MINIMUM) * max(bands / 3., 1.) * (2. if bytes_per_band == 4 else 1.)
+    return {'requests': n_requests, 'processing_units': n_requests * pu, 'download_bytes': download_bytes,
+            'disk_bytes': download_bytes, 'raw_bytes': raw_bytes, 'shape': shape}
+
+
+def _human(n_bytes):
+    for unit in ('B', 'kB', 'MB', 'GB'):
+        if abs(n_bytes) < 1024.:
+            return '{:.1f} {}'.format(n_bytes, unit)
+        n_bytes /= 1024.
+    return '{:.1f} TB'.format(n_bytes)
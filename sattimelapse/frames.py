@@ -0,0 +1,196 @@
+"""
+Frame selection methods shared by ``SentinelHubTimelapse`` and ``cloud_ts.sentinelhub_ts.timeseries``.
+
+The mixin works on the attributes both classes hold: ``project_name``, ``bbox``, ``dates``, ``dates64``, ``mask``,
+``preview_folder``, ``previews``, ``cloud_masks``, ``cloud_coverage``, ``invalid_coverage``, ``coverage_table`` and
+``luts``.
+"""
+
+import glob
+import logging
+import os
+
+import numpy as np
+
+from sattimelapse.coverage import CoverageTable
+from sattimelapse.harmonize import channel_histograms, reference_histogram, matching_luts
+from sattimelapse.quality import score_previews, quality_report
+from sattimelapse.locking import atomic_path
+from sattimelapse.phash import dct_hash, find_duplicates
+from sattimelapse.renditions import DEFAULT_RENDITIONS, render
+
+LOGGER = logging.getLogger(__name__)
+
+
+class FramesMixin(object):
+    """
+    Coverage queries, frame selection and outputs of a stack of acquisitions.
+    """
+
+    def _get_coverage_folder(self):
+        return os.path.join(self.project_name, 'cloudmasks')
+
+    def build_coverage_tables(self):
+        """
+        Builds summed-area tables of the cloud masks and of the preview validity masks and saves them next to
+        ``cloudmasks.npy``, so that coverage of any sub-window can be queried with ``get_window_coverage``.
+        """
+        # previews may have been filtered together with the dates, their alpha band stays aligned
+        valid_masks = self.previews[:, :, :, -1] if self.previews is not None else None
+        self.coverage_table = CoverageTable.from_masks(self.cloud_masks, valid_masks)
+        self.coverage_table.save(self._get_coverage_folder())
+        return self.coverage_table
+
+    def get_coverage_table(self):
+        """
+        Returns the summed-area tables, built once from the masks on first use and then read from memory or from
+        the saved file. They are rebuilt only if the cloud masks were recomputed (see ``_reset_coverage_tables``),
+        the number of dates changed or previews were loaded since.
+        """
+        if self.coverage_table is None:
+            self.coverage_table = CoverageTable.load(self._get_coverage_folder())
+
+        table = self.coverage_table
+        if table is None or table.cloud_table is None or len(table.cloud_table) != len(self.dates) or \
+                (table.valid_table is None and self.previews is not None):
+            if self.cloud_masks is None:
+                raise ValueError('Coverage tables are not available. Run mask_cloudy_images() first.')
+            table = self.build_coverage_tables()
+        return table
+
+    def _reset_coverage_tables(self):
+        """
+        Drops the tables of previous cloud masks, in memory and on disk.
+        """
+        self.coverage_table = None
+        filename = os.path.join(self._get_coverage_folder(), CoverageTable.FILENAME)
+        if os.path.isfile(filename):
+            os.remove(filename)
+
+    def get_window_coverage(self, window=None, sub_bbox=None):
+        """
+        Returns cloud and invalid area coverage of a sub-window for all dates, read from the summed-area tables.
+
+        :param window: relative window ``(x0, y0, x1, y1)`` measured from the upper-left corner, whole frame if None
+        :type window: tuple of floats or None
+        :param sub_bbox: sub-window in the CRS of the project bbox, overrides ``window``
+        :type sub_bbox: sentinelhub.BBox or None
+        :return: cloud coverage and invalid coverage (None if previews were not loaded) per date
+        :rtype: tuple of numpy.ndarray
+        """
+        table = self.get_coverage_table()
+
+        if sub_bbox is not None:
+            window = CoverageTable.window_from_bbox(self.bbox, sub_bbox)
+
+        cloud_coverage = table.cloud_coverage(window) if table.cloud_table is not None else None
+        invalid_coverage = table.invalid_coverage(window) if table.valid_table is not None else None
+        return cloud_coverage, invalid_coverage
+
+    def mask_duplicate_images(self, max_distance=6, max_days=3., rehash=False):
+        """
+        Marks near-duplicate images, e.g. from overlapping orbits or adjacent days. Previews are compared with a DCT
+        perceptual hash to the last kept neighbour; of two duplicates the one with lower cloud and invalid coverage
+        is kept. Run it before downloading full res images so redundant frames are not fetched.
+
+        :param max_distance: largest Hamming distance, out of 64 bits, of two duplicates
+        :type max_distance: int
+        :param max_days: largest time difference in days of two duplicates
+        :type max_days: float
+        :param rehash: whether to recompute hashes cached next to the previews
+        :type rehash: bool
+        """
+        hashes = self._get_preview_hashes(rehash)
+
+        scores = np.zeros(len(self.dates))
+        if self.cloud_coverage is not None:
+            scores += self.cloud_coverage
+        if self.invalid_coverage is not None:
+            scores += self.invalid_coverage
+
+        days = self.dates64.astype(np.int64) / 86400.
+        duplicates = find_duplicates(hashes, days, self.mask == 0, scores, max_distance=max_distance,
+                                     max_days=max_days)
+        self.mask[duplicates] = 1
+
+        LOGGER.info('%d near-duplicate images masked.', np.count_nonzero(duplicates))
+
+    def _get_preview_hashes(self, rehash=False):
+        """
+        Returns perceptual hashes of the previews, computed once and cached in the previews folder.
+        """
+        hash_filename = os.path.join(self.preview_folder, 'phash.npz')
+        dates = self.dates64.astype(str)
+
+        if not rehash and os.path.isfile(hash_filename):
+            with np.load(hash_filename) as data:
+                if np.array_equal(data['dates'], dates):
+                    return data['hashes']
+
+        hashes = dct_hash(self.previews)
+        if not os.path.exists(self.preview_folder):
+            os.makedirs(self.preview_folder)
+        with atomic_path(hash_filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
+            np.savez(fp, dates=dates, hashes=hashes)
+        return hashes
+
+    def mask_bad_images(self, thresholds=None, filename='quality_report.csv'):
+        """
+        Marks broken acquisitions (haze, stripes, saturation, partial swaths) detected from preview statistics and
+        writes a per-frame report explaining which check flagged each frame.
+
+        :param thresholds: overrides of ``sattimelapse.quality.DEFAULT_THRESHOLDS`` ('min_spread', 'max_saturation',
+            'max_nodata_rows', 'max_outlier')
+        :type thresholds: dict or None
+        :param filename: csv file name within project folder, the report is not written if None
+        :type filename: str or None
+        :return: per-frame metrics and reasons
+        :rtype: pandas.DataFrame
+        """
+        report = quality_report(score_previews(self.previews), self.dates, thresholds)
+        self.mask[report['bad'].values] = 1
+
+        if filename:
+            report.to_csv(os.path.join(self.project_name, filename))
+        LOGGER.info('%d images flagged by the quality checks.', report['bad'].sum())
+        return report
+
+    def compute_harmonisation_luts(self, strength=1.):
+        """
+        Computes per-frame histogram-matching lookup tables from the previews against the median composite of the
+        unmasked previews, so that ``create_timelapse(harmonize=True)`` gives frames of stable brightness.
+
+        :param strength: 0 keeps frames unchanged, 1 fully matches the reference composite
+        :type strength: float
+        """
+        valid = self.previews[..., 3] > 0
+        reference = reference_histogram(self.previews, valid, self.mask == 0)
+        self.luts = matching_luts(channel_histograms(self.previews, valid), reference, strength=strength)
+
+    def _get_unmasked_luts(self, harmonize):
+        """
+        Returns the lookup table of each unmasked frame, computed on first use, or None for each if not ``harmonize``.
+        """
+        indices = np.flatnonzero(self.mask == 0)
+        if not harmonize:
+            return [None] * len(indices)
+        if self.luts is None:
+            self.compute_harmonisation_luts()
+        return list(self.luts[indices])
+
+    def _get_timelapse_files(self, subdir='timelapse'):
+        return sorted(glob.glob(self.project_name + '/' + subdir + '/*png'))
+
+    def make_renditions(self, renditions=DEFAULT_RENDITIONS, fps=3):
+        """
+        Writes several outputs (videos at different sizes, GIF, thumbnails) in one pass: each timelapse frame is
+        decoded once and fed to all the resizers and encoders, which run concurrently.
+
+        :param renditions: rendition specs, e.g. ``[{'name': 'timelapse_720p.mp4', 'kind': 'video', 'height': 720}]``
+        :type renditions: list of dict
+        :param fps: frames per second
+        :type fps: int
+        :return: paths of the renditions
+        :rtype: list of str
+        """
+        return render(self._get_timelapse_files(), self.project_name, renditions=renditions, fps=fps)
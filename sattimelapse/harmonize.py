@@ -0,0 +1,85 @@
+"""
+Temporal radiometric harmonisation of frames with per-frame histogram-matching lookup tables.
+
+Lookup tables are computed on the small previews against a reference composite, then applied to the full res frames
+as uint8 table lookups, so the per-frame cost is one pass over the pixels.
+"""
+
+import warnings
+
+import numpy as np
+
+
+def channel_histograms(previews, valid):
+    """
+    Returns the histograms of the RGB channels of valid pixels of each preview, of shape ``(n, 3, 256)``. Counts are
+    taken frame by frame on the uint8 data, so no copy of the stack is made.
+    """
+    histograms = np.zeros((previews.shape[0], 3, 256), dtype=np.int64)
+    for index in range(previews.shape[0]):
+        for channel in range(3):
+            histograms[index, channel] = np.bincount(previews[index, ..., channel][valid[index]], minlength=256)
+    return histograms
+
+
+def reference_histogram(previews, valid, selected=None, max_bytes=64e6):
+    """
+    Returns the channel histograms ``(3, 256)`` of the median composite of the selected previews. The median is
+    computed over blocks of rows of the selected previews only, holding at most about ``max_bytes`` of float32.
+    """
+    indices = np.arange(previews.shape[0]) if selected is None else np.flatnonzero(selected)
+    height, width = previews.shape[1:3]
+    block_height = int(max(1, max_bytes // max(1, len(indices) * width * 3 * 4)))
+
+    histogram = np.zeros((3, 256), dtype=np.int64)
+    for rownum in range(0, height, block_height):
+        rows = slice(rownum, rownum + block_height)
+        stack = previews[indices, rows, :, :3].astype(np.float32)
+        stack[~valid[indices, rows]] = np.nan
+        with warnings.catch_warnings():
+            # pixels never valid stay NaN and are dropped
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            composite = np.nanmedian(stack, axis=0)
+
+        composite_valid = np.all(np.isfinite(composite), axis=-1)
+        composite = np.nan_to_num(composite).round().clip(0, 255).astype(np.uint8)
+        histogram += channel_histograms(composite[np.newaxis], composite_valid[np.newaxis])[0]
+    return histogram
+
+
+def matching_luts(histograms, reference, strength=1.):
+    """
+    Returns uint8 lookup tables ``(n, 3, 256)`` mapping each frame's channel distributions onto the reference.
+
+    :param histograms: channel histograms of the frames ``(n, 3, 256)``
+    :type histograms: numpy.ndarray
+    :param reference: channel histograms of the reference ``(3, 256)``
+    :type reference: numpy.ndarray
+    :param strength: 0 keeps frames unchanged, 1 fully matches the reference
+    :type strength: float
+    :rtype: numpy.ndarray of uint8
+    """
+    levels = np.arange(256, dtype=np.float64)
+    cdf = np.cumsum(histograms, axis=-1, dtype=np.float64)
+    cdf /= np.maximum(cdf[..., -1:], 1)
+    reference_cdf = np.cumsum(reference, axis=-1, dtype=np.float64)
+    reference_cdf /= np.maximum(reference_cdf[..., -1:], 1)
+
+    luts = np.empty(histograms.shape, dtype=np.uint8)
+    for index in range(histograms.shape[0]):
+        for channel in range(3):
+            if not histograms[index, channel].any():
+                matched = levels
+            else:
+                matched = np.interp(cdf[index, channel], reference_cdf[channel], levels)
+            luts[index, channel] = np.clip((1. - strength) * levels + strength * matched, 0, 255).round()
+    return luts
+
+
+def apply_lut(frame, lut):
+    """
+    Applies per-channel uint8 lookup tables ``(3, 256)`` to the RGB channels of ``frame`` in place.
+    """
+    for channel in range(3):
+        np.take(lut[channel], frame[..., channel], out=frame[..., channel], mode='clip')
+    return frame
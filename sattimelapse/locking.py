@@ -0,0 +1,63 @@
+"""
+Atomic writes and advisory folder locks, so that several processes can share stamps, cloud masks and downloads.
+
+Temporary files and lock files are hidden (leading dot), so that folder listings like ``glob(folder + '/*')`` never
+return them.
+"""
+
+import contextlib
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # no advisory locks outside POSIX, writes stay atomic
+    fcntl = None
+
+LOCK_FILENAME = '.lock'
+
+# read once, os.umask can only be queried by setting it, which is not thread safe
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+@contextlib.contextmanager
+def folder_lock(folder, shared=False):
+    """
+    Holds an advisory lock of ``folder`` (``flock`` of ``<folder>/.lock``) for the duration of the block, exclusive
+    unless ``shared``. Does nothing if ``folder`` is None.
+    """
+    if folder is None or fcntl is None:
+        yield
+        return
+
+    if not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, LOCK_FILENAME), 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """
+    Yields a temporary path next to ``path`` with the same extension, renamed to ``path`` when the block succeeds, so
+    that readers see either the previous file or the complete new one.
+    """
+    folder, name = os.path.split(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder or '.', prefix='.tmp_', suffix=os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        yield tmp_path
+        # mkstemp creates the file with mode 0600, give it the mode of a file created with open()
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
@@ -0,0 +1,178 @@
+"""
+Fetch mode with one full resolution request per date from which the previews are derived locally by block-averaging,
+plus one small request of the s2cloudless bands at cloud-mask resolution.
+
+Processing units grow with the number of output bands and double for FLOAT32 output, so the frames are requested as
+4 UINT8 bands (RGB and dataMask) and the cloud bands as UINT16 reflectance scaled by ``REFLECTANCE_SCALE``, at the
+cloud-mask resolution. Returning the 14 bands at full resolution in one FLOAT32 request would cost about 9 times the
+full res PNG, while the previews, cloud data and full res requests of the separate mode cost about 1.2 times. This
+mode saves the preview requests and halves the cost of the cloud data, i.e. two requests per date instead of three
+and about 10% fewer processing units, not a threefold saving.
+"""
+
+import os
+
+import numpy as np
+
+from sattimelapse.locking import atomic_path
+
+# AUTO maps reflectance 0-1 to 0-255, dataMask to 0 or 255
+RGBA_EVALSCRIPT = """//VERSION=3
+function setup() {
+    return {
+        input: ["B02", "B03", "B04", "dataMask"],
+        output: {bands: 4, sampleType: "AUTO"}
+    };
+}
+function evaluatePixel(s) {
+    return [%(gain)s * s.B04, %(gain)s * s.B03, %(gain)s * s.B02, s.dataMask];
+}
+"""
+
+REFLECTANCE_SCALE = 10000.
+
+CLOUD_EVALSCRIPT = """//VERSION=3
+function setup() {
+    return {
+        input: ["B01", "B02", "B04", "B05", "B08", "B8A", "B09", "B10", "B11", "B12"],
+        output: {bands: 10, sampleType: "UINT16"}
+    };
+}
+function evaluatePixel(s) {
+    return [s.B01, s.B02, s.B04, s.B05, s.B08, s.B8A, s.B09, s.B10, s.B11, s.B12].map(function (value) {
+        return %(scale)s * value;
+    });
+}
+"""
+
+
+class MultiOutputFetcher(object):
+    """
+    Downloads one RGBA frame per date at full resolution and the s2cloudless bands at cloud-mask resolution, and
+    derives the RGBA previews from the frames.
+    """
+
+    def __init__(self, request_class, preview_factor, cloud_kwargs, gain=2.5, preview_size=None, atmfilter=None,
+                 **request_kwargs):
+        """
+        :param request_class: WcsRequest or WmsRequest
+        :type request_class: class
+        :param preview_factor: block size, in full res pixels, of one preview pixel
+        :type preview_factor: int
+        :param cloud_kwargs: resolution (``resx``, ``resy``) or size (``width``, ``height``) of the cloud bands
+        :type cloud_kwargs: dict
+        :param gain: gain applied to reflectance of the RGB frames, as in the TRUE-COLOR layer
+        :type gain: float
+        :param preview_size: width and height the block-averaged previews are resized to, e.g. the ``preview_size``
+            of size-based requests, which is not a divisor of the frame size; a None dimension keeps the aspect ratio
+        :type preview_size: tuple or None
+        :param atmfilter: atmospheric correction of the frames, e.g. 'ATMCOR', none if None
+        :type atmfilter: str or None
+        :param request_kwargs: other request parameters (data_folder, layer, bbox, time, resolution or size, ...)
+        """
+        from sentinelhub.constants import MimeType, CustomUrlParam
+
+        self.preview_factor = max(int(preview_factor), 1)
+        self.gain = gain
+        self.preview_size = preview_size
+        frame_params = {CustomUrlParam.EVALSCRIPT: RGBA_EVALSCRIPT % {'gain': gain}}
+        if atmfilter is not None:
+            frame_params[CustomUrlParam.ATMFILTER] = atmfilter
+        self.request = request_class(image_format=MimeType.PNG, maxcc=1.0, custom_url_params=frame_params,
+                                     **request_kwargs)
+        self.cloud_request = request_class(image_format=MimeType.TIFF_d16, maxcc=1.0,
+                                           custom_url_params={CustomUrlParam.EVALSCRIPT:
+                                                              CLOUD_EVALSCRIPT % {'scale': REFLECTANCE_SCALE}},
+                                           **dict(request_kwargs, **cloud_kwargs))
+
+    def get_dates(self):
+        dates = self.request.get_dates()
+        if dates != self.cloud_request.get_dates():
+            raise ValueError('Lists of full resolution images and cloud bands do not match.')
+        return dates
+
+    def fetch(self, frame_folder, redownload=False, get_data=None):
+        """
+        Downloads all dates one at a time and derives the previews locally. Full res RGBA frames are also written
+        as ``<date>.png`` into ``frame_folder`` so that date stamping finds them as with separate requests.
+
+        :param get_data: function ``get_data(request, redownload=..., data_filter=...)`` used instead of
+            ``request.get_data``, e.g. to go through a response cache or an asynchronous downloader
+        :type get_data: callable or None
+        :return: full res RGBA frames, RGBA previews, cloud bands (reflectance) at cloud-mask resolution
+        :rtype: tuple of numpy.ndarray
+        """
+        from PIL import Image
+
+        if not os.path.exists(frame_folder):
+            os.makedirs(frame_folder)
+
+        if get_data is None:
+            def get_data(request, **kwargs):
+                return request.get_data(save_data=True, **kwargs)
+
+        frames, previews, cloud_bands = [], [], []
+        for index, date in enumerate(self.get_dates()):
+            frame = self.to_rgba(np.asarray(get_data(self.request, redownload=redownload, data_filter=[index])[0]))
+            with atomic_path(os.path.join(frame_folder, date.strftime("%Y-%m-%dT%H-%M-%S") + '.png')) as tmp_path:
+                Image.fromarray(frame).save(tmp_path)
+
+            frames.append(frame)
+            preview = self.block_reduce_rgba(frame, self.preview_factor)
+            if self.preview_size is not None:
+                preview = self.resize_rgba(preview, self.preview_size)
+            previews.append(preview)
+            bands = get_data(self.cloud_request, redownload=redownload, data_filter=[index])[0]
+            cloud_bands.append(np.asarray(bands, dtype=np.float32) / REFLECTANCE_SCALE)
+
+        return np.asarray(frames), np.asarray(previews), np.asarray(cloud_bands)
+
+    @staticmethod
+    def to_rgba(frame):
+        """
+        Returns the uint8 RGBA frame of a response of ``RGBA_EVALSCRIPT``.
+        """
+        rgba = np.asarray(frame, dtype=np.uint8)
+        if rgba.ndim == 3 and rgba.shape[2] == 4:
+            return rgba
+        raise ValueError('Expected an RGBA response, got shape {}.'.format(rgba.shape))
+
+    @staticmethod
+    def block_reduce_rgba(frame, factor):
+        """
+        Block-averages the colours of an RGBA frame, a block is transparent if any of its pixels is.
+        """
+        if factor == 1:
+            return frame
+        height, width = frame.shape[0] // factor, frame.shape[1] // factor
+        blocks = frame[:height * factor, :width * factor].reshape((height, factor, width, factor, 4))
+        preview = np.empty((height, width, 4), dtype=np.uint8)
+        preview[:, :, :3] = blocks[:, :, :, :, :3].mean(axis=(1, 3)).round()
+        preview[:, :, 3] = blocks[:, :, :, :, 3].min(axis=(1, 3))
+        return preview
+
+    @staticmethod
+    def resize_rgba(preview, size):
+        """
+        Resizes an RGBA preview to ``(width, height)``, bilinear for the colours and nearest for the transparency.
+        """
+        from PIL import Image
+
+        height, width = preview.shape[:2]
+        if size[0] is None and size[1] is None:
+            return preview
+        new_width = size[0] if size[0] is not None else max(int(round(width * size[1] / float(height))), 1)
+        new_height = size[1] if size[1] is not None else max(int(round(height * size[0] / float(width))), 1)
+        if (new_width, new_height) == (width, height):
+            return preview
+
+        rgb = Image.fromarray(preview[:, :, :3]).resize((new_width, new_height), Image.BILINEAR)
+        alpha = Image.fromarray(preview[:, :, 3]).resize((new_width, new_height), Image.NEAREST)
+        return np.dstack([np.asarray(rgb), np.asarray(alpha)])
+
+    @staticmethod
+    def resolution_factor(coarse_res, fine_res):
+        """
+        Returns the integer ratio of two resolutions given as strings such as '60m' and '10m'.
+        """
+        return int(round(float(str(coarse_res).rstrip('m')) / float(str(fine_res).rstrip('m'))))
@@ -0,0 +1,95 @@
+"""
+Vectorised DCT perceptual hash of preview stacks and near-duplicate detection.
+"""
+
+import numpy as np
+
+HASH_SIZE = 8
+IMAGE_SIZE = 32
+
+
+def dct_matrix(size):
+    """
+    Returns the orthonormal DCT-II matrix of a given size.
+    """
+    k = np.arange(size)[:, np.newaxis]
+    n = np.arange(size)[np.newaxis, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2. * size)) * np.sqrt(2. / size)
+    matrix[0] /= np.sqrt(2.)
+    return matrix
+
+
+def block_resize(images, size=IMAGE_SIZE):
+    """
+    Area-averages a stack of 2D images ``(n, height, width)`` to ``(n, size, size)``.
+    """
+    height, width = images.shape[1:3]
+    rows = np.linspace(0, height, size + 1).astype(int)[:-1]
+    cols = np.linspace(0, width, size + 1).astype(int)[:-1]
+    row_counts = np.diff(np.append(rows, height)).clip(min=1)
+    col_counts = np.diff(np.append(cols, width)).clip(min=1)
+
+    summed = np.add.reduceat(np.add.reduceat(images.astype(np.float32), rows, axis=1), cols, axis=2)
+    return summed / (row_counts[:, np.newaxis] * col_counts[np.newaxis, :])
+
+
+def dct_hash(previews):
+    """
+    Returns the 64-bit DCT hash of each preview.
+
+    :param previews: stack of RGB(A) previews ``(n, height, width, channels)``
+    :type previews: numpy.ndarray
+    :rtype: numpy.ndarray of uint64
+    """
+    gray = previews[..., :3].astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    small = block_resize(gray)
+    matrix = dct_matrix(IMAGE_SIZE).astype(np.float32)
+    coefficients = np.einsum('ij,njk,lk->nil', matrix, small, matrix)[:, :HASH_SIZE, :HASH_SIZE]
+
+    flat = coefficients.reshape(len(previews), -1)
+    # DC term excluded from the median
+    bits = flat > np.median(flat[:, 1:], axis=1, keepdims=True)
+    return np.packbits(bits, axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def hamming_distance(hash1, hash2):
+    """
+    Returns the number of differing bits of two (arrays of) hashes.
+    """
+    xor = np.bitwise_xor(np.asarray(hash1, dtype=np.uint64), np.asarray(hash2, dtype=np.uint64))
+    return np.unpackbits(np.atleast_1d(xor).view(np.uint8)).reshape(-1, 64).sum(axis=1)
+
+
+def find_duplicates(hashes, days, candidates, scores, max_distance=6, max_days=3.):
+    """
+    Walks candidate dates in temporal order and returns the ones within ``max_distance`` bits of the last kept
+    neighbour acquired at most ``max_days`` before. Of two duplicates the one with the lower score is kept.
+
+    :param hashes: hash of each date
+    :type hashes: numpy.ndarray of uint64
+    :param days: acquisition time of each date in days
+    :type days: numpy.ndarray of floats
+    :param candidates: dates which may be kept
+    :type candidates: numpy.ndarray of bool
+    :param scores: rank of each date, lower is better
+    :type scores: numpy.ndarray
+    :return: True for dates to mask
+    :rtype: numpy.ndarray of bool
+    """
+    duplicates = np.zeros(len(hashes), dtype=bool)
+    indices = np.flatnonzero(candidates)
+    if indices.size < 2:
+        return duplicates
+
+    kept = indices[0]
+    for index in indices[1:]:
+        if days[index] - days[kept] <= max_days and \
+                hamming_distance(hashes[index], hashes[kept])[0] <= max_distance:
+            if scores[index] < scores[kept]:
+                duplicates[kept] = True
+                kept = index
+            else:
+                duplicates[index] = True
+        else:
+            kept = index
+    return duplicates
@@ -0,0 +1,299 @@
+"""
+Named processing stages with content-hash checkpoints.
+
+Each stage records in a manifest the hash of its parameters and of the outputs of the stages it depends on, together
+with the hash of its own outputs. A rerun only executes stages whose key changed or whose outputs are missing, and an
+interrupted run resumes at the first stage which did not complete.
+"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+from sattimelapse.locking import atomic_path
+
+LOGGER = logging.getLogger(__name__)
+
+
+def hash_paths(paths, contents=True):
+    """
+    Returns the SHA-256 of the relative names and contents of files and of all files below directories. Hidden files
+    (locks, temporary files) are left out. Without ``contents``, sizes and modification times are hashed instead of
+    contents, for folders of downloads too large to read again.
+    """
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        if os.path.isdir(path):
+            filenames = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names
+                               if not name.startswith('.'))
+        else:
+            filenames = [path]
+        for filename in filenames:
+            digest.update(os.path.relpath(filename, os.path.dirname(path)).encode())
+            if not contents:
+                stat = os.stat(filename)
+                digest.update('{} {}'.format(stat.st_size, stat.st_mtime_ns).encode())
+                continue
+            with open(filename, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Stage(object):
+    """
+    A step of a pipeline.
+
+    :param name: name of the stage in the manifest
+    :type name: str
+    :param run: function running the stage
+    :type run: callable
+    :param depends: names of the stages whose outputs are inputs of this one
+    :type depends: list of str
+    :param params: parameters of the stage, JSON serialisable (other values are hashed by their str)
+    :type params: dict
+    :param outputs: files and folders written by the stage, or a function returning them
+    :type outputs: list of str or callable
+    :param load: function restoring the in-memory state of the stage from its outputs when it is skipped but a
+        following stage runs
+    :type load: callable or None
+    :param always: whether the stage runs on every call, e.g. a cheap catalogue query whose result may change
+    :type always: bool
+    :param hash_contents: whether outputs are hashed by content, else by name, size and modification time
+    :type hash_contents: bool
+    """
+
+    def __init__(self, name, run, depends=(), params=None, outputs=(), load=None, always=False,
+                 hash_contents=True):
+        self.name = name
+        self.run = run
+        self.depends = list(depends)
+        self.params = params or {}
+        self.outputs = outputs
+        self.load = load
+        self.always = always
+        self.hash_contents = hash_contents
+
+    def get_outputs(self):
+        return list(self.outputs() if callable(self.outputs) else self.outputs)
+
+    def get_key(self, input_hashes):
+        content = json.dumps({'params': self.params, 'inputs': input_hashes}, sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Pipeline(object):
+    """
+    Stages run in the order they were added, with a manifest in ``<project_name>/pipeline.json``.
+    """
+
+    def __init__(self, project_name, manifest_name='pipeline.json'):
+        self.project_name = project_name
+        self.manifest_filename = os.path.join(project_name, manifest_name)
+        self.stages = []
+
+    def add_stage(self, name, run, **kwargs):
+        stage = Stage(name, run, **kwargs)
+        names = [stage.name for stage in self.stages]
+        missing = [name for name in stage.depends if name not in names]
+        if missing:
+            raise ValueError('Stage {} depends on unknown stages {}'.format(name, missing))
+        self.stages.append(stage)
+        return stage
+
+    def load_manifest(self):
+        if not os.path.isfile(self.manifest_filename):
+            return {}
+        with open(self.manifest_filename) as fp:
+            return json.load(fp)
+
+    def save_manifest(self, manifest):
+        if not os.path.exists(self.project_name):
+            os.makedirs(self.project_name)
+        with atomic_path(self.manifest_filename) as tmp_filename, open(tmp_filename, 'w') as fp:
+            json.dump(manifest, fp, indent=1, sort_keys=True, default=str)
+
+    def status(self):
+        """
+        Returns the names of the stages which would run, without running anything. Stages following a stage which
+        will run are listed too since their inputs may change.
+        """
+        manifest = self.load_manifest()
+        output_hashes = {}
+        pending = []
+        for stage in self.stages:
+            inputs = {name: output_hashes.get(name) for name in stage.depends}
+            entry = manifest.get(stage.name)
+            if stage.always or any(name in pending for name in stage.depends) or \
+                    not self._is_done(stage, entry, stage.get_key(inputs)):
+                pending.append(stage.name)
+            else:
+                output_hashes[stage.name] = entry['output_hash']
+        return pending
+
+    def run(self, force=(), until=None):
+        """
+        Runs the stages whose parameters or inputs changed since the last run, or whose outputs are missing.
+
+        :param force: names of stages to run anyway
+        :type force: list of str
+        :param until: name of the last stage to run, all if None
+        :type until: str or None
+        :return: names of the stages which ran
+        :rtype: list of str
+        """
+        manifest = self.load_manifest()
+        output_hashes = {}
+        skipped = {}
+        ran = []
+
+        for stage in self.stages:
+            inputs = {name: output_hashes[name] for name in stage.depends}
+            key = stage.get_key(inputs)
+            entry = manifest.get(stage.name)
+            if not stage.always and stage.name not in force and self._is_done(stage, entry, key):
+                LOGGER.info('Stage %s is up to date.', stage.name)
+                output_hashes[stage.name] = entry['output_hash']
+                skipped[stage.name] = stage
+                if stage.name == until:
+                    break
+                continue
+
+            self._load_dependencies(stage, skipped)
+
+            # the stage is not done until it completes
+            manifest.pop(stage.name, None)
+            self.save_manifest(manifest)
+
+            LOGGER.info('Running stage %s.', stage.name)
+            stage.run()
+            outputs = stage.get_outputs()
+            output_hashes[stage.name] = hash_paths([path for path in outputs if os.path.exists(path)],
+                                                   contents=stage.hash_contents)
+            manifest[stage.name] = {'key': key, 'params': stage.params, 'inputs': inputs, 'outputs': outputs,
+                                    'output_hash': output_hashes[stage.name],
+                                    'finished': datetime.datetime.now().isoformat()}
+            self.save_manifest(manifest)
+            ran.append(stage.name)
+            if stage.name == until:
+                break
+        return ran
+
+    @staticmethod
+    def _is_done(stage, entry, key):
+        return entry is not None and entry['key'] == key and all(os.path.exists(path) for path in entry['outputs'])
+
+    def _load_dependencies(self, stage, skipped):
+        """
+        Restores the state of skipped stages the stage depends on, directly or through other skipped stages.
+        """
+        for name in stage.depends:
+            dependency = skipped.pop(name, None)
+            if dependency is None:
+                continue
+            self._load_dependencies(dependency, skipped)
+            if dependency.load is not None:
+                LOGGER.info('Loading outputs of stage %s.', name)
+                dependency.load()
+
+
+def timelapse_pipeline(timelapse, request_params=None, max_cc=0.33, threshold=None, max_invalid_coverage=0.01,
+                       mask_images=(), quality_checks=False, max_hash_distance=None, select_window=None,
+                       select_months=None, scale_factor=.43, harmonize=False, fps=3, renditions=None):
+    """
+    Returns the stages of a ``SentinelHubTimelapse`` run: catalogue, previews, cloud data, masks, full-res, stamps,
+    frames and video. Only full res images of the unmasked dates are downloaded, so e.g. changing ``max_cc`` reruns
+    masks, full-res, frames and video but downloads only the full res images of newly unmasked dates.
+
+    :param timelapse: timelapse created with ``new=True``
+    :type timelapse: SentinelHubTimelapse
+    :param request_params: parameters of the requests (bbox, time interval, resolutions, ...), a change triggers
+        new downloads
+    :type request_params: dict or None
+    :return: pipeline to ``run()``
+    :rtype: Pipeline
+    """
+    from sattimelapse.estimate import get_catalogue_filename, write_catalogue
+    from sattimelapse.time_lapse import CommonUtil, datestamps_dir
+
+    project_name = timelapse.project_name
+    state_folder = os.path.join(project_name, 'pipeline')
+    request_params = request_params or {}
+    pipeline = Pipeline(project_name)
+
+    def save_catalogue():
+        write_catalogue(get_catalogue_filename(project_name), timelapse.dates)
+
+    def get_previews():
+        timelapse.get_previews()
+        timelapse.plot_preview(filename='previews.pdf')
+
+    def mask():
+        timelapse.mask[:] = 0
+        timelapse.mask_invalid_images(max_invalid_coverage=max_invalid_coverage)
+        timelapse.mask_cloudy_images(max_cloud_coverage=max_cc, threshold=threshold)
+        timelapse.plot_cloud_masks(filename='cloudmasks.pdf')
+        timelapse.mask_images(list(mask_images))
+        if quality_checks:
+            timelapse.mask_bad_images()
+        if max_hash_distance is not None:
+            timelapse.mask_duplicate_images(max_distance=max_hash_distance)
+        if select_window is not None:
+            timelapse.select_best_frames(window=select_window, months=select_months)
+        with atomic_path(os.path.join(state_folder, 'mask.npy')) as tmp_filename:
+            np.save(tmp_filename, timelapse.mask)
+
+    def load_mask():
+        timelapse.mask[:] = np.load(os.path.join(state_folder, 'mask.npy'))
+
+    def get_stamp_files():
+        return [os.path.join(datestamps_dir, date.strftime("%Y-%m-%d") + '.png')
+                for date in timelapse._get_unmasked_dates()]
+
+    def create_frames():
+        # frames of dates masked since the previous run must not end up in the video
+        CommonUtil.clean_folder(os.path.join(project_name, 'timelapse'))
+        timelapse.create_timelapse(scale_factor=scale_factor, harmonize=harmonize)
+
+    def encode():
+        if renditions:
+            timelapse.make_renditions(renditions, fps=fps)
+        else:
+            timelapse.make_video_alternate(fps=fps)
+
+    def get_video_files():
+        if renditions:
+            return [os.path.join(project_name, spec['name']) for spec in renditions]
+        return [os.path.join(project_name, 'timelapse.mp4')]
+
+    pipeline.add_stage('catalogue', save_catalogue, params=request_params, always=True,
+                       outputs=[get_catalogue_filename(project_name)])
+    # in single fetch mode previews are derived from the full res frames and no preview is downloaded
+    preview_outputs = [timelapse.preview_folder] if timelapse.multi_fetcher is None else \
+        [timelapse.data_folder, timelapse.mask_folder]
+    # downloads are identified by their request parameters, their folders are hashed by name, size and mtime
+    pipeline.add_stage('previews', get_previews, depends=['catalogue'], params=request_params,
+                       outputs=preview_outputs, load=timelapse.get_previews, hash_contents=False)
+    pipeline.add_stage('cloud data', lambda: timelapse._run_cloud_detection(True, threshold),
+                       depends=['catalogue'], params=dict(request_params, threshold=threshold),
+                       outputs=[os.path.join(project_name, 'cloudmasks', 'cloudmasks.npy')],
+                       load=timelapse._load_cloud_masks)
+    pipeline.add_stage('masks', mask, depends=['previews', 'cloud data'],
+                       params={'max_cc': max_cc, 'max_invalid_coverage': max_invalid_coverage,
+                               'mask_images': list(mask_images), 'quality_checks': quality_checks,
+                               'max_hash_distance': max_hash_distance, 'select_window': select_window,
+                               'select_months': select_months},
+                       outputs=[os.path.join(state_folder, 'mask.npy')], load=load_mask)
+    pipeline.add_stage('full-res', lambda: timelapse.save_fullres_images(only_unmasked=True), depends=['masks'],
+                       params=request_params, outputs=[timelapse.data_folder], hash_contents=False)
+    pipeline.add_stage('stamps', timelapse.create_date_stamps, depends=['masks'], outputs=get_stamp_files)
+    pipeline.add_stage('frames', create_frames, depends=['full-res', 'stamps'],
+                       params={'scale_factor': scale_factor, 'harmonize': harmonize},
+                       outputs=[os.path.join(project_name, 'timelapse')])
+    pipeline.add_stage('video', encode, depends=['frames'], params={'fps': fps, 'renditions': renditions},
+                       outputs=get_video_files)
+    return pipeline
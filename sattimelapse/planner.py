@@ -0,0 +1,68 @@
+"""
+Resolution and request-type planner driven by a target frame size and per-product pixel budgets.
+"""
+
+import math
+
+# Sentinel-2 native resolutions in meters of the true colour bands and of the coarsest s2cloudless bands
+NATIVE_RES = 10
+CLOUD_NATIVE_RES = 60
+# largest image side accepted by the OGC services in one request
+MAX_REQUEST_PX = 2500
+
+DEFAULT_BUDGET = {'full': 1920 * 1080, 'preview': 455 * 256, 'cloud': 512 * 512}
+
+
+def plan_request(size_m, target_size=(1920, 1080), preview_size=(455, 256), budget=None,
+                 max_request_px=MAX_REQUEST_PX):
+    """
+    Picks resolutions (or image sizes) and the request type of each product from the geodesic size of the bbox.
+
+    The resolution of each product is the finest one that respects the native resolution, the target frame size and
+    the pixel budget. The full res product is requested with WCS at a resolution when it is bound by the native
+    resolution (small ponds are not upsampled), and with WMS at a size otherwise, keeping the aspect ratio of the
+    bbox (large reservoirs are not truncated to a fixed frame). Products larger than ``max_request_px`` per side are
+    coarsened to fit one request, as requests are not split into tiles.
+
+    :param size_m: E-W and N-S size of the bbox in meters, as returned by ``get_bbox_size``
+    :type size_m: tuple of floats
+    :param target_size: largest (width, height) of the timelapse frames
+    :type target_size: tuple of ints
+    :param preview_size: largest (width, height) of the previews
+    :type preview_size: tuple of ints
+    :param budget: largest number of pixels per image of each product ('full', 'preview', 'cloud')
+    :type budget: dict or None
+    :param max_request_px: largest image side of one request
+    :type max_request_px: int
+    :return: keyword arguments of ``SentinelHubTimelapse`` and the per-product plan
+    :rtype: tuple of (dict, dict)
+    """
+    budget = dict(DEFAULT_BUDGET, **(budget or {}))
+    width_m, height_m = size_m
+
+    def resolution(native, frame_size, n_pixels):
+        res = max(native, width_m / frame_size[0], height_m / frame_size[1],
+                  math.sqrt(width_m * height_m / float(n_pixels)), max(width_m, height_m) / float(max_request_px))
+        return int(math.ceil(res))
+
+    products = {}
+    full_res = resolution(NATIVE_RES, target_size, budget['full'])
+    preview_res = max(full_res, resolution(NATIVE_RES, preview_size, budget['preview']))
+    cloud_res = resolution(CLOUD_NATIVE_RES, preview_size, budget['cloud'])
+    for name, res in (('full', full_res), ('preview', preview_res), ('cloud', cloud_res)):
+        shape = (max(int(round(width_m / res)), 1), max(int(round(height_m / res)), 1))
+        products[name] = {'resolution': res, 'size': shape}
+
+    small_area = full_res == NATIVE_RES
+    kwargs = {'small_area': small_area}
+    if small_area:
+        kwargs.update(full_res=_res_string(full_res), preview_res=_res_string(preview_res),
+                      cloud_mask_res=_res_string(cloud_res))
+    else:
+        kwargs.update(full_size=products['full']['size'], preview_size=products['preview']['size'],
+                      cloud_mask_size=products['cloud']['size'])
+    return kwargs, products
+
+
+def _res_string(res):
+    return ('{}m'.format(res), '{}m'.format(res))
@@ -0,0 +1,84 @@
+"""
+Batched quality scoring of preview stacks to detect hazy, striped, saturated or partial acquisitions.
+"""
+
+import warnings
+
+import numpy as np
+
+DEFAULT_THRESHOLDS = {'min_spread': 0.08, 'max_saturation': 0.05, 'max_nodata_rows': 0.02, 'max_outlier': 3.5}
+
+
+def longest_run(flags, axis=-1):
+    """
+    Returns the length of the longest run of True values along ``axis``.
+    """
+    flags = np.moveaxis(flags, axis, -1)
+    count = np.cumsum(flags, axis=-1, dtype=np.int32)
+    # count reached at the last False before each position, subtracted to restart runs
+    restart = np.maximum.accumulate(np.where(flags, 0, count), axis=-1)
+    return (count - restart).max(axis=-1)
+
+
+def score_previews(previews, min_run=0.05):
+    """
+    Computes quality metrics of all previews at once.
+
+    - spread: 2-98 percentile range of the luminance of valid pixels, low for haze or fog
+    - saturation: fraction of valid pixels with a saturated channel
+    - nodata_rows: fraction of rows with a run of no-data (transparent or black) pixels longer than ``min_run`` of
+      the width, high for stripes and partial swaths
+    - outlier: robust z-score of the median absolute difference to the temporal median preview
+
+    :param previews: RGBA previews of shape ``(n, height, width, 4)``
+    :type previews: numpy.ndarray of uint8
+    :param min_run: shortest run of no-data pixels counted, as a fraction of the width
+    :type min_run: float
+    :return: metrics of each preview
+    :rtype: dict of numpy.ndarray
+    """
+    rgb = previews[..., :3]
+    valid = previews[..., 3] > 0 if previews.shape[-1] == 4 else np.ones(previews.shape[:3], dtype=bool)
+    nodata = ~valid | np.all(rgb == 0, axis=-1)
+
+    gray = rgb.astype(np.float32) @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    gray[nodata] = np.nan
+
+    with warnings.catch_warnings():
+        # fully invalid previews give NaN metrics
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        low, high = np.nanpercentile(gray, [2, 98], axis=(1, 2))
+        spread = (high - low) / 255.
+
+        saturated = np.any(rgb >= 250, axis=-1) & ~nodata
+        saturation = saturated.sum(axis=(1, 2)) / np.maximum((~nodata).sum(axis=(1, 2)), 1)
+
+        nodata_rows = np.mean(longest_run(nodata, axis=2) > min_run * previews.shape[2], axis=1)
+
+        deviation = np.nanmedian(np.abs(gray - np.nanmedian(gray, axis=0)), axis=(1, 2))
+        center = np.nanmedian(deviation)
+        mad = 1.4826 * np.nanmedian(np.abs(deviation - center))
+        outlier = (deviation - center) / mad if mad > 0 else np.zeros_like(deviation)
+
+    return {'spread': spread, 'saturation': saturation, 'nodata_rows': nodata_rows, 'outlier': outlier}
+
+
+def quality_report(metrics, dates, thresholds=None):
+    """
+    Returns a per-frame table of metrics, a ``bad`` flag and the reasons why a frame is flagged.
+    """
+    import pandas as pd
+
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    checks = [('hazy', metrics['spread'] < thresholds['min_spread']),
+              ('saturated', metrics['saturation'] > thresholds['max_saturation']),
+              ('no-data rows', metrics['nodata_rows'] > thresholds['max_nodata_rows']),
+              ('outlier', metrics['outlier'] > thresholds['max_outlier'])]
+
+    report = pd.DataFrame(metrics, index=pd.Index(dates, name='date'))
+    reasons = np.array([''] * len(report), dtype=object)
+    for name, flagged in checks:
+        reasons[flagged] = reasons[flagged] + name + ';'
+    report['reasons'] = [reason.rstrip(';') for reason in reasons]
+    report['bad'] = report['reasons'] != ''
+    return report
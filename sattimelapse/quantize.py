@@ -0,0 +1,90 @@
+"""
+Compact storage of float32 reflectance and probability cubes.
+"""
+
+import numpy as np
+
+
+class Quantizer(object):
+    """
+    Encodes float arrays as uint16 with a linear scale/offset, or as float16, and decodes them back to float32.
+
+    With uint16 the largest code is reserved for NaN, so values in ``[offset, offset + 65534 * scale]`` are
+    representable with a precision of ``scale``.
+    """
+
+    NODATA = np.iinfo(np.uint16).max
+
+    def __init__(self, dtype=None, scale=1e-4, offset=0.0):
+        """
+        :param dtype: storage dtype, 'uint16', 'float16' or None to keep float32
+        :type dtype: str or None
+        :param scale: quantisation step of uint16 codes
+        :type scale: float
+        :param offset: value of the uint16 code 0
+        :type offset: float
+        """
+        self.dtype = np.dtype(dtype) if dtype is not None else None
+        if self.dtype is not None and self.dtype not in (np.uint16, np.float16):
+            raise ValueError('Storage dtype must be uint16, float16 or None.')
+        self.scale = float(scale)
+        self.offset = float(offset)
+
+    def encode(self, array):
+        """
+        Returns ``array`` in the storage dtype.
+        """
+        array = np.asarray(array)
+        if self.dtype is None or array.dtype == self.dtype:
+            return array
+        if self.dtype == np.float16:
+            return array.astype(np.float16)
+
+        codes = np.round((array - self.offset) / self.scale)
+        nodata = ~np.isfinite(codes)
+        codes = np.clip(np.where(nodata, 0, codes), 0, self.NODATA - 1).astype(np.uint16)
+        codes[nodata] = self.NODATA
+        return codes
+
+    def decode(self, array):
+        """
+        Returns float32 values of an array in the storage dtype, float arrays are returned unchanged.
+        """
+        array = np.asarray(array)
+        if array.dtype != np.uint16:
+            return array.astype(np.float32, copy=False)
+
+        values = array.astype(np.float32) * np.float32(self.scale) + np.float32(self.offset)
+        values[array == self.NODATA] = np.nan
+        return values
+
+    def encode_stack(self, arrays):
+        """
+        Encodes a sequence of same-shape arrays one by one into a preallocated stack, so that the float32 stack is
+        never built.
+        """
+        stack = None
+        for index, array in enumerate(arrays):
+            encoded = self.encode(array)
+            if stack is None:
+                stack = np.empty((len(arrays),) + encoded.shape, dtype=encoded.dtype)
+            stack[index] = encoded
+        return stack if stack is not None else np.asarray(arrays)
+
+    def save(self, fp, array):
+        """
+        Saves ``array`` in the storage dtype together with its scale and offset, as an ``.npz`` archive.
+        """
+        np.savez(fp, data=self.encode(array), scale=self.scale, offset=self.offset)
+
+    @staticmethod
+    def load(fp):
+        """
+        Loads an array saved with ``save`` (or a plain ``np.save`` file of earlier versions) and returns float32
+        values.
+        """
+        data = np.load(fp)
+        if isinstance(data, np.ndarray):
+            return data
+        with data:
+            return Quantizer(scale=float(data['scale']), offset=float(data['offset'])).decode(data['data'])
@@ -0,0 +1,139 @@
+"""
+Multi-rendition output: timelapse frames are decoded once and fanned out to several resizers and encoders running
+in parallel threads (OpenCV resizing and encoding release the GIL).
+"""
+
+import os
+import queue
+import threading
+
+DEFAULT_RENDITIONS = (
+    {'name': 'timelapse_1080p.mp4', 'kind': 'video', 'height': 1080},
+    {'name': 'timelapse_720p.mp4', 'kind': 'video', 'height': 720},
+    {'name': 'timelapse.gif', 'kind': 'gif', 'width': 480},
+    {'name': 'thumbnails', 'kind': 'thumbnails', 'width': 320},
+)
+
+_END = object()
+
+
+class RenditionWriter(object):
+    """
+    Resizes and encodes the frames of one rendition spec.
+
+    A spec is a dict with a ``name`` (file or, for thumbnails, folder name), a ``kind`` ('video', 'gif' or
+    'thumbnails'), and optionally a target ``width`` and/or ``height`` (aspect ratio kept if only one is given) and
+    an ``fps`` overriding the common one.
+    """
+
+    def __init__(self, spec, output_folder, fps):
+        self.spec = spec
+        self.path = os.path.join(output_folder, spec['name'])
+        self.fps = spec.get('fps', fps)
+        self.writer = None
+        self.index = 0
+
+    def get_size(self, frame):
+        height, width = frame.shape[:2]
+        target_width, target_height = self.spec.get('width'), self.spec.get('height')
+        if target_width is None and target_height is None:
+            return width, height
+        if target_width is None:
+            target_width = width * target_height / float(height)
+        if target_height is None:
+            target_height = height * target_width / float(width)
+        # even sizes for the video codecs
+        return int(target_width) // 2 * 2, int(target_height) // 2 * 2
+
+    def write(self, frame):
+        import cv2
+        import imageio
+
+        size = self.get_size(frame)
+        if size != (frame.shape[1], frame.shape[0]):
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+
+        kind = self.spec['kind']
+        if kind == 'video':
+            if self.writer is None:
+                self.writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"mp4v"), self.fps, size)
+            self.writer.write(frame)
+        elif kind == 'gif':
+            if self.writer is None:
+                self.writer = imageio.get_writer(self.path, mode='I', fps=self.fps)
+            self.writer.append_data(frame[:, :, ::-1])
+        elif kind == 'thumbnails':
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            cv2.imwrite(os.path.join(self.path, '{:04d}.jpg'.format(self.index)), frame)
+        else:
+            raise ValueError('Unknown rendition kind {}'.format(kind))
+        self.index += 1
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.spec['kind'] == 'video':
+            self.writer.release()
+        else:
+            self.writer.close()
+
+
+def render(files, output_folder, renditions=DEFAULT_RENDITIONS, fps=3, max_queued=4):
+    """
+    Decodes each frame file once and writes all renditions concurrently.
+
+    :param files: frame image files in display order
+    :type files: list of str
+    :param output_folder: folder of the outputs
+    :type output_folder: str
+    :param renditions: rendition specs, see ``RenditionWriter``
+    :type renditions: list of dict
+    :param fps: frames per second of videos and GIFs
+    :type fps: int
+    :param max_queued: frames buffered per rendition, bounds memory when an encoder is slower than decoding
+    :type max_queued: int
+    :return: paths of the renditions
+    :rtype: list of str
+    """
+    import cv2
+
+    writers = [RenditionWriter(spec, output_folder, fps) for spec in renditions]
+    queues = [queue.Queue(maxsize=max_queued) for _ in writers]
+    errors = []
+
+    def work(writer, frames):
+        try:
+            while True:
+                frame = frames.get()
+                if frame is _END:
+                    break
+                writer.write(frame)
+        except Exception as exception:
+            errors.append(exception)
+            # keep draining so decoding is not blocked
+            while frames.get() is not _END:
+                pass
+        finally:
+            writer.close()
+
+    threads = [threading.Thread(target=work, args=(writer, frames), daemon=True)
+               for writer, frames in zip(writers, queues)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for filename in files:
+            frame = cv2.imread(filename)
+            for frames in queues:
+                # frames are read only by the writers, one decoded array is shared
+                frames.put(frame)
+    finally:
+        for frames in queues:
+            frames.put(_END)
+        for thread in threads:
+            thread.join()
+
+    if errors:
+        raise errors[0]
+    return [writer.path for writer in writers]
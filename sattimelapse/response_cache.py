@@ -0,0 +1,178 @@
+"""
+Content-addressed cache of Sentinel Hub responses shared across projects.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+from urllib.parse import urlsplit, parse_qsl
+
+from sattimelapse.locking import folder_lock, atomic_path
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.environ.get('SATTIMELAPSE_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.cache', 'sattimelapse', 'responses'))
+
+
+class ResponseCache(object):
+    """
+    Global cache of raw responses keyed by a canonical hash of the request parameters.
+
+    The key is built from the service URL with its query parameters (layer, bbox, time, resolution, evalscript,
+    format, ...) sorted and upper-cased, so the same tile requested from different projects or in a different
+    parameter order is downloaded once. The instance id is part of the URL path and thus of the key, as layers
+    are configured per instance.
+
+    Writes go through a temporary file renamed into place. When the cache exceeds ``max_bytes``, least recently
+    used responses are evicted (access time is tracked with the file modification time). A response evicted by
+    another process while it is read counts as a miss.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 1024 ** 3):
+        """
+        :param cache_dir: cache directory, ``$SATTIMELAPSE_CACHE`` or ``~/.cache/sattimelapse/responses`` if None
+        :type cache_dir: str or None
+        :param max_bytes: size quota of the cache in bytes
+        :type max_bytes: int
+        """
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    @staticmethod
+    def canonical_key(url):
+        """
+        Returns the sha256 hex digest of the canonical form of a request URL.
+        """
+        parts = urlsplit(url)
+        params = sorted((key.upper(), value) for key, value in parse_qsl(parts.query, keep_blank_values=True))
+        canonical = parts.netloc.lower() + parts.path + '?' + '&'.join('{}={}'.format(key, value)
+                                                                         for key, value in params)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def get_path(self, key, extension=''):
+        return os.path.join(self.cache_dir, key[:2], key + extension)
+
+    def get(self, url, file_path):
+        """
+        Copies the cached response of ``url`` to ``file_path``.
+
+        :return: True on cache hit, False otherwise
+        :rtype: bool
+        """
+        cached = self.get_path(self.canonical_key(url), os.path.splitext(file_path)[1])
+        if not os.path.isfile(cached):
+            self.misses += 1
+            return False
+
+        try:
+            os.utime(cached, None)
+            with atomic_path(file_path) as tmp_path:
+                shutil.copyfile(cached, tmp_path)
+        except OSError:
+            # evicted by another process since the check
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+
+    def put(self, url, file_path):
+        """
+        Stores the response saved in ``file_path`` for ``url`` and evicts old responses if over quota.
+        """
+        cached = self.get_path(self.canonical_key(url), os.path.splitext(file_path)[1])
+        if os.path.isfile(cached):
+            return
+
+        with atomic_path(cached) as tmp_path:
+            shutil.copyfile(file_path, tmp_path)
+        self._size = self.get_size() + os.path.getsize(file_path)
+        self.evict()
+
+    def fill(self, request, data_filter=None):
+        """
+        Copies cached responses of ``request`` which are not yet in its data folder.
+        """
+        # the size is known before responses are stored
+        self.get_size()
+        for download_request in self._get_download_list(request, data_filter):
+            file_path = download_request.get_file_path()
+            if not os.path.isfile(file_path):
+                self.get(download_request.url, file_path)
+
+    def store(self, request, data_filter=None):
+        """
+        Stores responses of ``request`` saved in its data folder.
+        """
+        for download_request in self._get_download_list(request, data_filter):
+            file_path = download_request.get_file_path()
+            if os.path.isfile(file_path):
+                self.put(download_request.url, file_path)
+
+    def evict(self):
+        """
+        Removes least recently used responses until the cache fits its quota. Evictions of processes sharing the
+        cache run one at a time.
+        """
+        if self.get_size() <= self.max_bytes:
+            return
+
+        with folder_lock(self.cache_dir):
+            entries = self._scan()
+            self._size = sum(entry[1] for entry in entries)
+            for _, size, path in sorted(entries):
+                if self._size <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._size -= size
+                self.evictions += 1
+
+    def get_size(self):
+        """
+        Returns the size of the cache in bytes, measured on first use and then tracked by ``put`` and ``evict``.
+        Other processes sharing the cache are accounted for at the next eviction.
+        """
+        if self._size is None:
+            self._size = sum(entry[1] for entry in self._scan())
+        return self._size
+
+    def _scan(self):
+        """
+        Returns ``(mtime, size, path)`` of the cached responses.
+        """
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                # temporary and lock files
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # removed meanwhile, e.g. where folder locks are not available
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    @staticmethod
+    def _get_download_list(request, data_filter=None):
+        download_list = request.get_download_list()
+        if data_filter is not None:
+            download_list = [download_list[index] for index in data_filter]
+        return [download_request for download_request in download_list if download_request.url]
@@ -0,0 +1,65 @@
+"""
+Site geometry helpers: bounding boxes from nominal water extent polygons.
+"""
+
+
+def shp2wkt(shapefile):
+    """
+    Writes the first geometry of a shapefile in WGS84 to a WKT file next to it.
+    """
+    import geopandas as gpd
+
+    tmp = gpd.GeoDataFrame.from_file(shapefile)
+    tmp.to_crs(epsg=4326, inplace=True)
+    wkt = tmp.geometry.values[0].to_wkt()
+
+    with open(shapefile.replace('shp', 'wkt'), "w") as text_file:
+        text_file.write(wkt)
+
+
+def bbox_creator(wkt_file, inflate_bbox=0.5, minsize=[0.025, 0.015]):
+    """
+    Returns the WGS84 bounding box of the polygon of a WKT file, inflated by ``inflate_bbox`` of its size on each
+    side and at least ``minsize`` degrees wide and high.
+    """
+    from sentinelhub import BBox, CRS
+    from shapely.wkt import loads
+
+    with open(wkt_file, 'r') as f:
+        wkt = f.read()
+
+    nominal = loads(wkt)
+
+    # inflate the BBOX
+    minx, miny, maxx, maxy = nominal.bounds
+    delx = maxx - minx
+    dely = maxy - miny
+
+    # set minimal frame size
+    delx = max(delx * inflate_bbox, minsize[0])
+    dely = max(dely * inflate_bbox, minsize[1])
+
+    minx = minx - delx
+    maxx = maxx + delx
+    miny = miny - dely
+    maxy = maxy + dely
+
+    return BBox(bbox=[minx, miny, maxx, maxy], crs=CRS.WGS84)
+
+
+def get_bbox_size(bbox):
+    """
+    Returns the E-W and N-S sizes of a WGS84 bounding box in meters.
+    """
+    from geographiclib.geodesic import Geodesic
+
+    geod = Geodesic.WGS84
+    b = bbox.get_polygon()
+    p1_lat, p1_lon = b[0][0], b[0][1]
+    p2_lat, p2_lon = b[1][0], b[1][1]
+    p3_lat, p3_lon = b[2][0], b[2][1]
+
+    gx = geod.Inverse(p1_lat, p1_lon, p2_lat, p2_lon)
+    gy = geod.Inverse(p2_lat, p2_lon, p3_lat, p3_lon)
+    print("Distance is E-W x N-S {:.2f}m x {:.2f}m".format(gx['s12'], gy['s12']))
+    return gx['s12'], gy['s12']
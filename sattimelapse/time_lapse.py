@@ -10,17 +10,17 @@ import glob
 
 from dateutil.rrule import rrule, MONTHLY
 
-from itertools import compress
-
-import cv2
-import imageio
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
 
-from sentinelhub.data_request import WmsRequest, WcsRequest
-from sentinelhub.constants import MimeType, CustomUrlParam
-from s2cloudless import CloudMaskRequest, MODEL_EVALSCRIPT
+from sattimelapse.frames import FramesMixin
+from sattimelapse.composite import TemporalComposites
+from sattimelapse.quantize import Quantizer
+from sattimelapse.multi_output import MultiOutputFetcher
+from sattimelapse.response_cache import ResponseCache
+from sattimelapse.async_client import AsyncDownloader
+from sattimelapse.dates import to_datetime64, calendar_filter, window_index, select_best_per_window
+from sattimelapse.harmonize import apply_lut
+from sattimelapse.locking import folder_lock, atomic_path
 
 appdir = os.path.dirname(os.path.abspath(__file__))
 datestamps_dir = os.path.join(appdir, 'datestamps')
@@ -28,16 +28,17 @@ datestamps_dir = os.path.join(appdir, 'datestamps')
 LOGGER = logging.getLogger(__name__)
 
 
-class SentinelHubTimelapse(object):
+class SentinelHubTimelapse(FramesMixin):
     """
     Class for creating timelapses with Sentinel-2 images using Sentinel Hub's Python library.
     """
 
     def __init__(self, project_name, bbox=None, time_interval=None, new=True, clean=False, instance_id='',
                  full_res=('10m', '10m'), preview_res=('60m', '60m'), cloud_mask_res=('60m', '60m'),
-                 full_size=(1920, 1080), preview_size=(455, 256),
+                 full_size=(1920, 1080), preview_size=(455, 256), cloud_mask_size=None,
                  use_atmcor=False, layer='TRUE-COLOR-S2-L1C',
-                 time_difference=datetime.timedelta(hours=2),small_area=True):
+                 time_difference=datetime.timedelta(hours=2),small_area=True, storage_dtype=None,
+                 fetch_mode='separate', response_cache=None, async_downloader=None):
 
         self.project_name = project_name
         self.preview_folder = os.path.join(project_name, 'previews')
@@ -49,6 +50,24 @@ class SentinelHubTimelapse(object):
         self.previews = None
         self.full_res = full_res
         self.timelapse = None
+        self.bbox = bbox
+        self.coverage_table = None
+        self.luts = None
+        self.composites = None
+        self.cloud_probs = None
+        # cloud probabilities do not need float32: optional uint16 (scale/offset) or float16 storage, kept in memory
+        # in the storage dtype, get_cloud_probs returns float32
+        self.prob_quantizer = Quantizer(storage_dtype, scale=1. / (Quantizer.NODATA - 1))
+        # fetch_mode 'single' downloads one full res image per date (previews derived locally) and the cloud bands
+        self.multi_fetcher = None
+        self.cloud_bands = None
+        # shared cache of raw responses, True for the default location
+        self.response_cache = ResponseCache() if response_cache is True else response_cache
+        # asyncio download layer, True for default settings with a journal in the project folder
+        if async_downloader is True:
+            async_downloader = AsyncDownloader(journal_filename=os.path.join(project_name, 'download_journal.jsonl'))
+        self.async_downloader = async_downloader
+        self.cloud_data_request = None
 
         if clean:
             self.clean_all()
@@ -56,7 +75,29 @@ class SentinelHubTimelapse(object):
         if not new:
             return
 
-        if small_area:
+        # request libraries are only needed to download
+        from sentinelhub.data_request import WmsRequest, WcsRequest
+        from sentinelhub.constants import MimeType, CustomUrlParam
+        from s2cloudless import CloudMaskRequest, MODEL_EVALSCRIPT
+
+        if fetch_mode == 'single':
+            self.preview_request = self.fullres_request = None
+            atmfilter = 'ATMCOR' if use_atmcor else None
+            if small_area:
+                self.multi_fetcher = MultiOutputFetcher(
+                    WcsRequest, MultiOutputFetcher.resolution_factor(preview_res[0], full_res[0]),
+                    {'resx': cloud_mask_res[0], 'resy': cloud_mask_res[1]}, atmfilter=atmfilter,
+                    data_folder=self.mask_folder, layer=layer, bbox=bbox, time=time_interval, resx=full_res[0],
+                    resy=full_res[1], instance_id=instance_id, time_difference=time_difference)
+            else:
+                cloud_mask_size = preview_size if cloud_mask_size is None else cloud_mask_size
+                # block averaging by the integer factor, then resizing to the exact preview size
+                self.multi_fetcher = MultiOutputFetcher(
+                    WmsRequest, full_size[0] // preview_size[0],
+                    {'width': cloud_mask_size[0], 'height': cloud_mask_size[1]}, preview_size=preview_size,
+                    atmfilter=atmfilter, data_folder=self.mask_folder, layer=layer, bbox=bbox, time=time_interval,
+                    width=full_size[0], height=full_size[1], instance_id=instance_id, time_difference=time_difference)
+        elif small_area:
             self.preview_request = WcsRequest(data_folder=self.preview_folder, layer=layer, bbox=bbox,
                                               time=time_interval, resx=preview_res[0], resy=preview_res[1],
                                               maxcc=1.0, image_format=MimeType.PNG, instance_id=instance_id,
@@ -88,31 +129,42 @@ class SentinelHubTimelapse(object):
                                           custom_url_params={CustomUrlParam.TRANSPARENT: True,
                                               CustomUrlParam.ATMFILTER: 'ATMCOR'} if use_atmcor else {CustomUrlParam.TRANSPARENT: True},
                                           time_difference=time_difference)
-            cloud_mask_res=('180m','180m')
+            # cloud data of size-based requests are fetched at cloud_mask_size, preview size by default
+            cloud_mask_size = preview_size if cloud_mask_size is None else cloud_mask_size
 
             wcs_request = WmsRequest(data_folder=self.mask_folder, layer=layer, bbox=bbox, time=time_interval,
-                                 width=preview_size[0], height=preview_size[1], maxcc=1.0,
+                                 width=cloud_mask_size[0], height=cloud_mask_size[1], maxcc=1.0,
                                  image_format=MimeType.TIFF_d32f, instance_id=instance_id,
                                  time_difference=time_difference, custom_url_params={CustomUrlParam.EVALSCRIPT:
                                                                                          MODEL_EVALSCRIPT})
 
-        self.cloud_mask_request = CloudMaskRequest(wcs_request)
+        if self.multi_fetcher is None:
+            self.cloud_data_request = wcs_request
+            self.cloud_mask_request = CloudMaskRequest(wcs_request)
+        else:
+            self.cloud_mask_request = None
 
         self.transparency_data = None
         self.preview_transparency_data = None
         self.invalid_coverage = None
 
-        self.dates = self.preview_request.get_dates()
+        if self.multi_fetcher is not None:
+            self.dates = self.multi_fetcher.get_dates()
+        else:
+            self.dates = self.preview_request.get_dates()
         if not self.dates:
             raise ValueError('Input parameters are not valid. No Sentinel 2 image is found.')
 
-        if self.dates != self.fullres_request.get_dates():
-            raise ValueError('Lists of previews and full resolution images do not match.')
+        if self.multi_fetcher is None:
+            if self.dates != self.fullres_request.get_dates():
+                raise ValueError('Lists of previews and full resolution images do not match.')
 
-        if self.dates != self.cloud_mask_request.get_dates():
-            raise ValueError('List of previews and cloud masks do not match.')
+            if self.dates != self.cloud_mask_request.get_dates():
+                raise ValueError('List of previews and cloud masks do not match.')
 
         self.mask = np.zeros((len(self.dates),), dtype=np.uint8)
+        # vectorised index of the dates for calendar filters and window grouping
+        self.dates64 = to_datetime64(self.dates)
 
         LOGGER.info('Found %d images of %s between %s and %s.', len(self.dates), project_name,
                     time_interval[0], time_interval[1])
@@ -136,24 +188,74 @@ class SentinelHubTimelapse(object):
         Downloads and returns an numpy array of previews if previews were not already downloaded and saved to disk.
         Set `redownload` to True if to force downloading the previews again.
         """
+        if self.multi_fetcher is not None:
+            self._fetch_single(redownload)
+            return
 
-        self.previews = np.asarray(self.preview_request.get_data(save_data=True, redownload=redownload))
+        self.previews = np.asarray(self._get_request_data(self.preview_request, redownload=redownload))
         self.preview_transparency_data = self.previews[:, :, :, -1]
 
         LOGGER.info('%d previews have been downloaded and stored to numpy array of shape %s.', self.previews.shape[0],
                     self.previews.shape)
 
-    def save_fullres_images(self, redownload=False):
+    def save_fullres_images(self, redownload=False, only_unmasked=False):
         """
         Downloads and saves fullres images used to produce the timelapse. Note that images for all available dates
         within the specified time interval are downloaded, although they will be for example masked due to too high
         cloud coverage.
+
+        With `only_unmasked`, only images not marked in ``self.mask`` (e.g. after ``select_best_frames``) are
+        downloaded and saved to disk, they are not kept in memory.
         """
+        if self.multi_fetcher is not None:
+            self._fetch_single(redownload)
+            return
 
-        data4d = np.asarray(self.fullres_request.get_data(save_data=True, redownload=redownload))
+        if only_unmasked:
+            self._get_request_data(self.fullres_request, redownload=redownload,
+                                   data_filter=list(np.flatnonzero(self.mask == 0)))
+            return
+
+        data4d = np.asarray(self._get_request_data(self.fullres_request, redownload=redownload))
         self.full_res_data = data4d[:, :, :, :-1]
         self.transparency_data = data4d[:, :, :, -1]
 
+    def _get_request_data(self, request, redownload=False, **kwargs):
+        """
+        Returns data of ``request``, consulting the shared response cache first and downloading missing responses
+        with the asynchronous downloader if they are set.
+        """
+        with folder_lock(request.data_folder):
+            data_filter = kwargs.get('data_filter')
+            if self.response_cache is not None and not redownload:
+                self.response_cache.fill(request, data_filter)
+            if self.async_downloader is not None:
+                self.async_downloader.prefetch(request, data_filter=data_filter, redownload=redownload)
+                redownload = False
+
+            data = request.get_data(save_data=True, redownload=redownload, **kwargs)
+
+            if self.response_cache is not None:
+                self.response_cache.store(request, data_filter)
+            return data
+
+    def _fetch_single(self, redownload=False):
+        """
+        Downloads the full res frame and the cloud bands of each date and derives the previews from the frames.
+        Nothing is done if they were already fetched, unless `redownload` is True.
+        """
+        if self.cloud_bands is not None and not redownload:
+            return
+
+        frames, previews, self.cloud_bands = self.multi_fetcher.fetch(self.data_folder, redownload=redownload,
+                                                                      get_data=self._get_request_data)
+        self.full_res_data = frames[:, :, :, :-1]
+        self.transparency_data = frames[:, :, :, -1]
+        self.previews = previews
+        self.preview_transparency_data = previews[:, :, :, -1]
+
+        LOGGER.info('%d images have been downloaded with a single full res request per date.', frames.shape[0])
+
     def plot_preview(self, within_range=None, filename=None):
         """
         Plots all previews if within_range is None, or only previews in a given range.
@@ -172,11 +274,15 @@ class SentinelHubTimelapse(object):
         """
         Plots all cloud masks if within_range is None, or only masks in a given range.
         """
+        import matplotlib.pyplot as plt
+
         within_range = CommonUtil.get_within_range(within_range, self.cloud_masks.shape[0])
         self._plot_image(self.cloud_masks[within_range[0]: within_range[1]],
                          factor=1, cmap=plt.cm.binary, filename=filename)
 
     def _plot_image(self, data, factor=2.5, cmap=None, filename=None):
+        import matplotlib.pyplot as plt
+
         rows = data.shape[0] // 5 + (1 if data.shape[0] % 5 else 0)
         aspect_ratio = (1.0 * data.shape[1]) / data.shape[2]
         fig, axs = plt.subplots(nrows=rows, ncols=5, figsize=(15, 3 * rows * aspect_ratio))
@@ -219,20 +325,78 @@ class SentinelHubTimelapse(object):
         if not os.path.exists(self.project_name + '/cloudmasks'):
             os.makedirs(self.project_name + '/cloudmasks')
 
-        with open(cloud_masks_filename, 'wb') as fp:
+        with atomic_path(cloud_masks_filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
             np.save(fp, self.cloud_masks)
+        # tables of the previous masks are stale
+        self._reset_coverage_tables()
+
+    def _load_cloud_probs(self):
+        """
+        Loads cloud probabilities from disk, if they already exist, in the storage dtype as after cloud detection.
+        """
+        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npz'
+        if not os.path.isfile(cloud_probs_filename):
+            # written by earlier versions
+            cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npy'
+
+        if not os.path.isfile(cloud_probs_filename):
+            return False
+
+        with open(cloud_probs_filename, 'rb') as fp:
+            # the file may have been written with another storage dtype
+            self.cloud_probs = self.prob_quantizer.encode(Quantizer.load(fp))
+        return True
+
+    def get_cloud_probs(self, start=None, stop=None):
+        """
+        Returns float32 cloud probabilities of dates ``start:stop``, dequantised from the storage dtype.
+        """
+        return self.prob_quantizer.decode(self.cloud_probs[start:stop])
+
+    def _save_cloud_probs(self):
+        """
+        Saves cloud probabilities to disk in the storage dtype.
+        """
+        cloud_probs_filename = self.project_name + '/cloudmasks/cloudprobs.npz'
+
+        if not os.path.exists(self.project_name + '/cloudmasks'):
+            os.makedirs(self.project_name + '/cloudmasks')
+
+        with atomic_path(cloud_probs_filename) as tmp_filename, open(tmp_filename, 'wb') as fp:
+            self.prob_quantizer.save(fp, self.cloud_probs)
 
     def _run_cloud_detection(self, rerun, threshold):
         """
         Determines cloud masks for each acquisition.
         """
-        loaded = self._load_cloud_masks()
-        if loaded and not rerun:
-            LOGGER.info('Nothing to do. Masks are loaded.')
-        else:
-            LOGGER.info('Downloading cloud data and running cloud detection. This may take a while.')
-            self.cloud_masks = self.cloud_mask_request.get_cloud_masks(threshold=threshold)
-            self._save_cloud_masks()
+        from s2cloudless import S2PixelCloudDetector
+
+        with folder_lock(os.path.join(self.project_name, 'cloudmasks')):
+            loaded = self._load_cloud_masks()
+            if loaded and not rerun:
+                LOGGER.info('Nothing to do. Masks are loaded.')
+            else:
+                LOGGER.info('Downloading cloud data and running cloud detection. This may take a while.')
+                if self.multi_fetcher is not None:
+                    # same defaults as CloudMaskRequest, run on the cloud bands fetched along with the frames
+                    self._fetch_single()
+                    detector = S2PixelCloudDetector(threshold=0.4 if threshold is None else threshold, average_over=4,
+                                                    dilation_size=2)
+                    cloud_probs = detector.get_cloud_probability_maps(self.cloud_bands)
+                    self.cloud_masks = detector.get_mask_from_prob(cloud_probs)
+                else:
+                    if self.response_cache is not None:
+                        self.response_cache.fill(self.cloud_data_request)
+                    if self.async_downloader is not None:
+                        self.async_downloader.prefetch(self.cloud_data_request)
+                    self.cloud_masks = self.cloud_mask_request.get_cloud_masks(threshold=threshold)
+                    if self.response_cache is not None:
+                        self.response_cache.store(self.cloud_data_request)
+                    # probabilities were computed along with the masks, no new download
+                    cloud_probs = self.cloud_mask_request.get_probability_masks()
+                self._save_cloud_masks()
+                self.cloud_probs = self.prob_quantizer.encode(cloud_probs)
+                self._save_cloud_probs()
 
     def mask_cloudy_images(self, rerun=False, max_cloud_coverage=0.1, threshold=None):
         """
@@ -250,9 +414,7 @@ class SentinelHubTimelapse(object):
 
         self.cloud_coverage = np.asarray([self._get_coverage(mask) for mask in self.cloud_masks])
 
-        for index in range(0, len(self.mask)):
-            if self.cloud_coverage[index] > max_cloud_coverage:
-                self.mask[index] = 1
+        self.mask[self.cloud_coverage > max_cloud_coverage] = 1
 
     def mask_invalid_images(self, max_invalid_coverage=0.1):
         """
@@ -264,49 +426,158 @@ class SentinelHubTimelapse(object):
         """
 
         # low-res and hi-res images/cloud masks may differ, just to be safe
-        coverage_fullres = np.asarray([1.0 - self._get_coverage(mask) for mask in self.transparency_data])
         coverage_preview = np.asarray([1.0 - self._get_coverage(mask) for mask in self.preview_transparency_data])
+        if self.transparency_data is not None:
+            coverage_fullres = np.asarray([1.0 - self._get_coverage(mask) for mask in self.transparency_data])
+            self.invalid_coverage = np.array([max(x, y) for x, y in zip(coverage_fullres, coverage_preview)])
+        else:
+            # full res images are not downloaded yet, e.g. before select_best_frames
+            self.invalid_coverage = coverage_preview
+
+        self.mask[self.invalid_coverage > max_invalid_coverage] = 1
+
+    def select_best_frames(self, window='month', months=None):
+        """
+        Keeps only the best-ranked unmasked acquisition of each time window and marks the others. Acquisitions are
+        ranked by cloud coverage plus invalid area coverage, so run it after ``mask_invalid_images`` and
+        ``mask_cloudy_images``, and before downloading full res images.
+
+        :param window: time window, 'week', 'month', 'season', 'year' or '<N>d' (e.g. '10d')
+        :type window: str
+        :param months: months (1-12) to keep, all if None
+        :type months: list of ints or None
+        """
+        scores = np.zeros(len(self.dates))
+        if self.cloud_coverage is not None:
+            scores += self.cloud_coverage
+        if self.invalid_coverage is not None:
+            scores += self.invalid_coverage
+
+        candidates = (self.mask == 0) & calendar_filter(self.dates64, months=months)
+
+        keep = select_best_per_window(window_index(self.dates64, window), scores, candidates)
+        self.mask[~keep] = 1
+
+        LOGGER.info('%d acquisitions selected, one per %s.', np.count_nonzero(keep), window)
+
+    def build_composites(self, period='month', n_bins=32, only_unmasked=False, save=True):
+        """
+        Builds the clear-observation count map and cloud-free mean and median composites per period from the
+        full res frames and the cloud masks. Frames are accumulated one at a time and year-month composites are
+        finished month by month, so memory does not grow with the number of dates.
+
+        :param period: one of 'all', 'month', 'season', 'year-month'
+        :type period: str
+        :param n_bins: number of histogram bins used for the approximate median
+        :type n_bins: int
+        :param only_unmasked: whether to skip images marked in ``self.mask``
+        :type only_unmasked: bool
+        :param save: whether to save composites and count map into the composites subdirectory, composites are
+            then written as their period finishes instead of being kept in ``finished``
+        :type save: bool
+        :return: composites for each period
+        :rtype: TemporalComposites
+        """
+        from PIL import Image
+
+        folder = os.path.join(self.project_name, 'composites')
+
+        def save_composites(key, mean, median):
+            Image.fromarray(median).save(os.path.join(folder, key + '_median.png'))
+            Image.fromarray(mean).save(os.path.join(folder, key + '_mean.png'))
+
+        if save and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        composites = None
+        for index, date, frame in self._iter_fullres_frames():
+            if only_unmasked and self.mask[index]:
+                continue
+            if composites is None:
+                composites = TemporalComposites(frame.shape[:2], period=period, n_bins=n_bins,
+                                                on_finish=save_composites if save else None)
+
+            clear = frame[:, :, -1] > 0
+            if self.cloud_masks is not None:
+                clear &= TemporalComposites.resize_mask(self.cloud_masks[index], frame.shape[:2]) == 0
+            composites.update(date, frame[:, :, :3], clear)
 
-        self.invalid_coverage = np.array([max(x, y) for x, y in zip(coverage_fullres, coverage_preview)])
+        if composites is None:
+            raise ValueError('No full res frame available to build composites.')
 
-        for index in range(0, len(self.mask)):
-            if self.invalid_coverage[index] > max_invalid_coverage:
-                self.mask[index] = 1
+        composites.finish()
+        if save:
+            np.save(os.path.join(folder, 'clear_count.npy'), composites.clear_count())
+
+        self.composites = composites
+        return composites
+
+    def _iter_fullres_frames(self):
+        """
+        Yields index, date and RGBA full res frame for all dates, one frame at a time from disk if full res data
+        are not held in memory.
+        """
+        from PIL import Image
+
+        for index, date in enumerate(self.dates):
+            if self.full_res_data is not None:
+                frame = np.dstack((self.full_res_data[index], self.transparency_data[index]))
+            else:
+                filename = self._get_filename(self.data_folder, date.strftime("%Y-%m-%dT%H-%M-%S"))
+                if filename is None:
+                    continue
+                frame = np.asarray(Image.open(filename).convert('RGBA'))
+            yield index, date, frame
 
     def mask_images(self, idx):
         """
         Manually mask images with given indexes.
         """
-        for index in idx:
-            self.mask[index] = 1
+        self.mask[np.asarray(idx, dtype=int)] = 1
 
     def unmask_images(self, idx):
         """
         Manually unmask images with given indexes.
         """
-        for index in idx:
-            self.mask[index] = 0
+        self.mask[np.asarray(idx, dtype=int)] = 0
+
+    def mask_dates(self, months=None, seasons=None, years=None):
+        """
+        Marks images acquired outside the given months, seasons and years.
+
+        :param months: months (1-12) to keep, all if None
+        :type months: list of ints or None
+        :param seasons: seasons to keep, e.g. ['JJA', 'SON'], all if None
+        :type seasons: list of str or None
+        :param years: years to keep, all if None
+        :type years: list of ints or None
+        """
+        self.mask[~calendar_filter(self.dates64, months=months, seasons=seasons, years=years)] = 1
 
     def create_date_stamps(self):
         """
         Create date stamps to be included to gif.
         """
-        filtered = list(compress(self.dates, list(np.logical_not(self.mask))))
+        with folder_lock(datestamps_dir):
+            filtered = self._get_unmasked_dates()
 
-        if not os.path.exists(datestamps_dir):
-            os.makedirs(datestamps_dir)
+            if not os.path.exists(datestamps_dir):
+                os.makedirs(datestamps_dir)
 
-        for date in filtered:
-            datefile = os.path.join(datestamps_dir, date.strftime("%Y-%m-%d") + '.png')
-            if not os.path.isfile(datefile):
-                TimestampUtil.create_date_stamp(date, filtered[0], filtered[-1], datefile)
+            for date in filtered:
+                datefile = os.path.join(datestamps_dir, date.strftime("%Y-%m-%d") + '.png')
+                if not os.path.isfile(datefile):
+                    TimestampUtil.create_date_stamp(date, filtered[0], filtered[-1], datefile)
 
-    def create_timelapse(self, scale_factor=0.3):
+    def create_timelapse(self, scale_factor=0.3, harmonize=False):
         """
         Adds date stamps to full res images and stores them in timelapse subdirectory.
-        """
-        filtered = list(compress(self.dates, list(np.logical_not(self.mask))))
 
+        :param scale_factor: width of the date stamp relative to the frame width
+        :type scale_factor: float
+        :param harmonize: whether to apply the lookup tables of ``compute_harmonisation_luts`` to the frames
+        :type harmonize: bool
+        """
         if not os.path.exists(self.project_name + '/timelapse'):
             os.makedirs(self.project_name + '/timelapse')
 
@@ -315,7 +586,14 @@ class SentinelHubTimelapse(object):
                                          self.project_name + '/timelapse/' + date.strftime(
                                              "%Y-%m-%dT%H-%M-%S") + '.png',
                                          self._get_filename(datestamps_dir, date.strftime("%Y-%m-%d")),
-                                         scale_factor=scale_factor) for date in filtered]
+                                         scale_factor=scale_factor, lut=lut)
+            for date, lut in zip(self._get_unmasked_dates(), self._get_unmasked_luts(harmonize))]
+
+    def _get_unmasked_dates(self):
+        """
+        Returns datetime instances of images not marked in ``self.mask``.
+        """
+        return list(np.asarray(self.dates, dtype=object)[self.mask == 0])
 
     @staticmethod
     def _get_coverage(mask):
@@ -334,8 +612,7 @@ class SentinelHubTimelapse(object):
         :return: datetime instance
         :rtype: datetime
         """
-        chunks = list(map(int, date.split('T')[0].split('-')))
-        return datetime(chunks[0], chunks[1], chunks[2])
+        return to_datetime64(date.split('T')[0]).item()
 
     @staticmethod
     def _datetime_to_iso(date, only_date=True):
@@ -374,12 +651,10 @@ class SentinelHubTimelapse(object):
                 return filename
         return None
 
-    def _get_timelapse_files(self, subdir='timelapse'):
-        return sorted(glob.glob(self.project_name + '/' + subdir + '/*png'))
-
     def _get_timelapse_images(self):
         if self.timelapse is None:
-            data = np.array(self.fullres_request.get_data())[:, :, :, :-1]
+            data = self.full_res_data if self.multi_fetcher is not None else \
+                np.array(self.fullres_request.get_data())[:, :, :, :-1]
             return [data[idx] for idx, _ in enumerate(data) if self.mask[idx] == 0]
         return self.timelapse
 
@@ -391,6 +666,7 @@ class SentinelHubTimelapse(object):
         :param is_color:
         :type is_color: bool
         """
+        import cv2
 
         images = np.array([image[:, :, [2, 1, 0]] for image in self._get_timelapse_images()])
         self.full_size = (int(images.shape[2]), int(images.shape[1]))
@@ -414,6 +690,8 @@ class SentinelHubTimelapse(object):
         :param is_color:
         :type is_color: bool
         """
+        import cv2
+
         video_fullname = os.path.join(self.project_name, video_name)
 
         images = self._get_timelapse_files()  # [img for img in os.listdir(image_folder) if img.endswith(".png")]
@@ -434,6 +712,8 @@ class SentinelHubTimelapse(object):
         :param fps: frames per second
         :type fps: int
         """
+        import imageio
+
         with imageio.get_writer(os.path.join(self.project_name, filename), mode='I', fps=fps) as writer:
             for filename in self._get_timelapse_files():
                 image = imageio.imread(filename)
@@ -447,9 +727,13 @@ class TimestampUtil:
 
     @staticmethod
     def add_date_stamp(input_image_path, output_image_path, watermark_image_path,
-                       scale_factor=0.3, minsize=1000):
+                       scale_factor=0.3, minsize=1000, lut=None):
+        from PIL import Image
 
         base_image = Image.open(input_image_path)
+        if lut is not None:
+            # harmonised before resizing, on the fewest pixels
+            base_image = Image.fromarray(apply_lut(np.array(base_image), lut))
         w, h = base_image.size
         if w < minsize:
             scale = minsize / w
@@ -467,12 +751,15 @@ class TimestampUtil:
         transparent = Image.new('RGBA', (width, height), (0, 0, 0, 0))
         transparent.paste(base_image, (0, 0))
         transparent.paste(watermark, (width - int(scale * w_width), 0), mask=watermark)
-        transparent.save(output_image_path)
+        with atomic_path(output_image_path) as tmp_path:
+            transparent.save(tmp_path)
         # Convert RGBA to RGB and return as numpy
         return np.array(transparent.convert('RGB').getdata()).reshape(height, width, 3).astype(np.uint8)
 
     @staticmethod
     def create_date_stamp(current_dt, start_dt, end_dt, filename):
+        import matplotlib.pyplot as plt
+
         years = TimestampUtil._get_years_in_range(start_dt, end_dt)
         equal_year_size = [1] * len(years)
 
@@ -508,7 +795,9 @@ class TimestampUtil:
         ax.text(1.3, 0.8, str(current_dt.year), fontsize=100, color=sh_colors['light'], weight='medium')
         ax.text(2., -0.3, current_dt.strftime('%b'), fontsize=100, color=sh_colors['light'], weight='medium')
 
-        fig.savefig(filename, transparent=True, dpi=300, )
+        # stamps are shared between projects, readers must not see partial files
+        with atomic_path(filename) as tmp_filename:
+            fig.savefig(tmp_filename, transparent=True, dpi=300, )
         plt.close()
 
     @staticmethod
@@ -1,12 +1,17 @@
 # coding=utf-8
 import os
 import sys
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from esasnappy import GPF
 from esasnappy import jpy
-from esasnappy import ProductUtils
 from dateutil import parser
 
+from sattimelapse.locking import atomic_path
+
 
 class info:
     def __init__(self, product, sensordata):
@@ -52,6 +57,8 @@ class info:
         self.oot = []
         self.solar_irr = []
         self.U = 1.
+        # coarse grids of the angle bands, see get_geometry
+        self.geometry = None
 
         # data type for pixel values
         self.type = np.float32
@@ -100,62 +107,119 @@ class info:
             # self.VZA[i].loadRasterData()
             # self.VAZI[i].loadRasterData()
 
-    def load_data(self, rownum):
-        from multiprocessing import Pool
-        from contextlib import closing
-        # construct arrays
-        self.hcld = np.zeros(self.width, dtype=self.type, order='F')
-        self.rs2 = [np.zeros(self.width, dtype=self.type) for i in range(self.N)]
-        self.vza = [np.zeros(self.width, dtype=self.type) for i in range(self.N)]
-        self.razi = [np.zeros(self.width, dtype=self.type) for i in range(self.N)]
-        self.sza = np.zeros(self.width, dtype=self.type, order='F')
-        self.sazi = np.zeros(self.width, dtype=self.type, order='F')
-        self.muv = [np.zeros(self.width, dtype=self.type) for i in range(self.N)]
+    def get_geometry(self, step=60):
+        '''read the sun and view angle bands once on a coarse grid (their native raster if smaller than the scene,
+        every step pixels otherwise); load_block then interpolates them bilinearly instead of reading full res angles'''
+        self.geometry = {'sza': angle_grid(self.SZA, self.width, self.height, step),
+                         'sazi': angle_grid(self.SAZI, self.width, self.height, step, circular=True),
+                         'vza': [angle_grid(band, self.width, self.height, step) for band in self.VZA],
+                         'vazi': [angle_grid(band, self.width, self.height, step, circular=True) for band in self.VAZI]}
+
+    def allocate_block(self, block_height):
+        '''allocate the buffers of a block of rows, reused by all the following reads of that height'''
+        npix = block_height * self.width
+        self.block_height = block_height
+        self._hcld = np.zeros(npix, dtype=self.type, order='F')
+        self._sza = np.zeros(npix, dtype=self.type, order='F')
+        self._sazi = np.zeros(npix, dtype=self.type, order='F')
+        self._mu0 = np.zeros(npix, dtype=self.type, order='F')
+        # one contiguous column per band, filled in place by readPixels
+        self._rs2 = np.zeros((npix, self.N), dtype=self.type, order='F')
+        self._vza = np.zeros((npix, self.N), dtype=self.type, order='F')
+        self._razi = np.zeros((npix, self.N), dtype=self.type, order='F')
+        self._muv = np.zeros((npix, self.N), dtype=self.type, order='F')
+
+    def load_block(self, rownum, nrows, n_workers=1):
+        '''load rows [rownum, rownum + nrows) of all bands into the block buffers;
+        pixels are flattened row by row: rs2, vza, razi and muv are (nrows * width, N) Fortran arrays,
+        sza, sazi, mu0 and hcld are (nrows * width) arrays.
+        The arrays are views of buffers overwritten by the next call, copy them to keep them.
+        With n_workers > 1 the bands are read in parallel threads.'''
+        if getattr(self, 'block_height', None) is None or nrows > self.block_height:
+            self.allocate_block(nrows)
+        npix = nrows * self.width
+
+        self.hcld = self._hcld[:npix]
+        self.sza = self._sza[:npix]
+        self.sazi = self._sazi[:npix]
+        self.mu0 = self._mu0[:npix]
+        self.rs2 = self._rs2[:npix]
+        self.vza = self._vza[:npix]
+        self.razi = self._razi[:npix]
+        self.muv = self._muv[:npix]
 
         # load data
-
-        self.SZA.readPixels(0, rownum, self.width, 1, self.sza)
-        self.SAZI.readPixels(0, rownum, self.width, 1, self.sazi)
-        self.mu0 = np.cos(np.radians(self.sza))
+        if self.geometry is None:
+            self.SZA.readPixels(0, rownum, self.width, nrows, self.sza)
+            self.SAZI.readPixels(0, rownum, self.width, nrows, self.sazi)
+        else:
+            self.geometry['sza'].interpolate(rownum, nrows, self.sza)
+            self.geometry['sazi'].interpolate(rownum, nrows, self.sazi)
+        np.cos(np.radians(self.sza, out=self.mu0), out=self.mu0)
         try:
-            self.product.getBand(self.sensordata.cirrus).readPixels(0, rownum, self.width, 1, self.hcld)
+            self.product.getBand(self.sensordata.cirrus).readPixels(0, rownum, self.width, nrows, self.hcld)
         except:
             print("No cirrus band available, high cloud flag discarded")
 
         # convert (if needed) into TOA reflectance
         if "LANDSAT" in self.sensor:
-            self.hcld = self.hcld * np.pi / (self.mu0 * self.U * 366.97)
-
-        for iband in range(self.N):
-            # print('loading band '+ str(i))
-            # l2h.b[iband].readValidMask(0, y, l2h.width, 1, v)
-            # invalid = np.where(v == 0, 1, 0) | invalid
-            self.B[iband].readPixels(0, rownum, self.width, 1, self.rs2[iband])
-            self.rs2[iband] = np.ma.array(self.rs2[iband], mask=self.rs2[iband] <= 0., fill_value=np.nan)
-
-            self.VZA[iband].readPixels(0, rownum, self.width, 1, self.vza[iband])
-            self.VAZI[iband].readPixels(0, rownum, self.width, 1, self.razi[iband])
-
-            # get relative azimuth in OSOAA convention (=0 when sat and sun in opposition)
-            self.razi[iband] = 180. - (self.razi[iband] - self.sazi)
-            self.razi[iband] = np.array([j % 360 for j in self.razi[iband]])
-            self.muv[iband] = np.cos(np.radians(self.vza[iband]))
+            self.hcld *= np.pi / (self.mu0 * self.U * 366.97)
+
+        def load_band(iband):
+            # columns of Fortran arrays are contiguous: read in place
+            self.B[iband].readPixels(0, rownum, self.width, nrows, self._rs2[:npix, iband])
+            if self.geometry is None:
+                self.VZA[iband].readPixels(0, rownum, self.width, nrows, self._vza[:npix, iband])
+                self.VAZI[iband].readPixels(0, rownum, self.width, nrows, self._razi[:npix, iband])
+            else:
+                self.geometry['vza'][iband].interpolate(rownum, nrows, self._vza[:npix, iband])
+                self.geometry['vazi'][iband].interpolate(rownum, nrows, self._razi[:npix, iband])
 
             # convert (if needed) into TOA reflectance
             if "LANDSAT" in self.sensor:
-                self.rs2[iband] = self.rs2[iband] * np.pi / (self.mu0 * self.U * self.solar_irr[iband] * 10)
+                self.rs2[:, iband] *= np.pi / (self.mu0 * self.U * self.solar_irr[iband] * 10)
+
+        self._map_bands(load_band, n_workers)
 
-        # convert into FORTRAN 2D arrays (here, np.array)
-        self.rs2 = np.array(self.rs2, order='F').T
-        self.razi = np.array(self.razi, order='F').T
-        self.vza = np.array(self.vza, order='F').T
+        # get relative azimuth in OSOAA convention (=0 when sat and sun in opposition)
+        np.subtract(self.razi, self.sazi[:, np.newaxis], out=self.razi)
+        np.subtract(180., self.razi, out=self.razi)
+        np.mod(self.razi, 360., out=self.razi)
+        np.cos(np.radians(self.vza, out=self.muv), out=self.muv)
 
-    #     print('multiproc')
-    #     with closing(Pool(8)) as p:
-    #         return(p.map(self.f, range(self.N)))
-    #
-    # def f(self,iband):
-    #     self.B[iband].readPixels(0, 0, self.width, self.height, self.rs2[iband])
+    def iter_blocks(self, block_height=256, n_workers=1):
+        '''iterate over the product by blocks of rows, yields (rownum, nrows) once the block is loaded'''
+        self.allocate_block(min(block_height, self.height))
+        for rownum in range(0, self.height, block_height):
+            nrows = min(block_height, self.height - rownum)
+            self.load_block(rownum, nrows, n_workers=n_workers)
+            yield rownum, nrows
+
+    def load_data(self, rownum):
+        '''load one row of all bands, see load_block'''
+        self.load_block(rownum, 1)
+
+    def load_bands(self, rownum=0, nrows=None, n_workers=None):
+        '''read the bands of rows [rownum, rownum + nrows) (default: to the end of the product) in parallel threads,
+        one per band by default (jpy releases the GIL during the JNI reads);
+        returns one (nrows, width, N) array, a view of a band-major buffer so that each band is read in place'''
+        nrows = self.height - rownum if nrows is None else nrows
+        data = np.zeros((self.N, nrows, self.width), dtype=self.type)
+
+        def load_band(iband):
+            self.B[iband].readPixels(0, rownum, self.width, nrows, data[iband].reshape(-1))
+
+        self._map_bands(load_band, n_workers or self.N)
+        return data.transpose(1, 2, 0)
+
+    def _map_bands(self, function, n_workers):
+        if n_workers is None or n_workers <= 1:
+            for iband in range(self.N):
+                function(iband)
+            return
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            # list() raises the exceptions of the workers
+            list(pool.map(function, range(self.N)))
 
     def unload_data(self):
 
@@ -259,6 +323,11 @@ class info:
         ac_product.writeHeader(String(self.outfile + ".dim"))
         self.l2_product = ac_product
 
+    def get_writer(self, block_height=512, background=True):
+        '''buffered writer of the bands of the L2 product, see create_product and block_writer'''
+        return block_writer(self.l2_product, list(self.l2_product.getBandNames()), block_height=block_height,
+                            background=background)
+
     def print_info(self):
         ''' print info, can be used to check if object is complete'''
         print("Product: %s, %d x %d pixels, %s" % (self.name, self.width, self.height, self.description))
@@ -267,7 +336,162 @@ class info:
             print("Band " + str(i) + " at " + str(self.B[i].getSpectralWavelength()) + "nm loaded")
 
 
+class angle_grid:
+    '''Smooth angle field of a band held on a coarse grid and bilinearly interpolated on blocks of rows'''
+
+    def __init__(self, band, width, height, step=60, circular=False):
+        self.width = width
+        native_width, native_height = band.getRasterWidth(), band.getRasterHeight()
+        if native_width < width or native_height < height:
+            # multi-size product: the band is the coarse grid, its pixel centers mapped on the scene
+            self.grid = np.zeros(native_width * native_height, dtype=np.float32)
+            band.readPixels(0, 0, native_width, native_height, self.grid)
+            self.grid = self.grid.reshape(native_height, native_width)
+            self.rows = (np.arange(native_height) + 0.5) * height / native_height - 0.5
+            self.cols = (np.arange(native_width) + 0.5) * width / native_width - 0.5
+        else:
+            rows = np.unique(np.append(np.arange(0, height, step), height - 1))
+            cols = np.unique(np.append(np.arange(0, width, step), width - 1))
+            self.grid = np.zeros((len(rows), len(cols)), dtype=np.float32)
+            buffer = np.zeros(width, dtype=np.float32)
+            for i, row in enumerate(rows):
+                band.readPixels(0, int(row), width, 1, buffer)
+                self.grid[i] = buffer[cols]
+            self.rows, self.cols = rows.astype(np.float64), cols.astype(np.float64)
+
+        self.fill_nodata()
+        if circular:
+            # remove the 0/360 jumps so that interpolation does not cross them, callers take angles modulo 360
+            self.grid = np.degrees(np.unwrap(np.unwrap(np.radians(self.grid), axis=1), axis=0)).astype(np.float32)
+
+        # column weights are the same for all blocks
+        self.col_index, self.col_weight = self.get_weights(self.cols, np.arange(width))
+
+    def fill_nodata(self):
+        '''fill the NaN grid nodes (outside of the detector footprints) by interpolation along rows then columns'''
+        for grid in (self.grid, self.grid.T):
+            for line in grid:
+                valid = np.isfinite(line)
+                if valid.any() and not valid.all():
+                    line[~valid] = np.interp(np.flatnonzero(~valid), np.flatnonzero(valid), line[valid])
+
+    @staticmethod
+    def get_weights(nodes, positions):
+        '''index of the node before each position and the weight of the node after it'''
+        if len(nodes) < 2:
+            return np.zeros(len(positions), dtype=int), np.zeros(len(positions), dtype=np.float32)
+        index = np.clip(np.searchsorted(nodes, positions, side='right') - 1, 0, len(nodes) - 2)
+        weight = np.clip((positions - nodes[index]) / (nodes[index + 1] - nodes[index]), 0., 1.)
+        return index, weight.astype(np.float32)
+
+    def interpolate(self, rownum, nrows, out):
+        '''write the angles of rows [rownum, rownum + nrows) into the flat array out of nrows * width values'''
+        out = out.reshape(nrows, self.width)
+        row_index, row_weight = self.get_weights(self.rows, np.arange(rownum, rownum + nrows))
+        last = np.minimum(row_index + 1, len(self.rows) - 1)
+        lines = self.grid[row_index] * (1. - row_weight[:, np.newaxis]) + self.grid[last] * row_weight[:, np.newaxis]
+
+        last = np.minimum(self.col_index + 1, len(self.cols) - 1)
+        np.multiply(lines[:, self.col_index], 1. - self.col_weight, out=out)
+        out += lines[:, last] * self.col_weight
+        return out
+
+
+class block_writer:
+    '''Collects processed rows of the bands of a product (header already written) and writes them with
+    writeRasterData in blocks of block_height rows, from a background thread if background is True so that
+    computation and disk writes overlap'''
+
+    def __init__(self, product, band_names, block_height=512, background=True):
+        self.width = product.getSceneRasterWidth()
+        self.block_height = min(block_height, product.getSceneRasterHeight())
+        self.bands = {name: product.getBand(name) for name in band_names}
+
+        # two buffers in background mode: one filled while the other is written
+        self.free = queue.Queue()
+        for _ in range(2 if background else 1):
+            self.free.put({name: np.full(self.block_height * self.width, np.nan, dtype=np.float32)
+                           for name in band_names})
+        self.buffer = self.free.get()
+        self.start = None
+        self.filled = 0
+
+        self.error = None
+        self.jobs = None
+        if background:
+            self.jobs = queue.Queue(maxsize=1)
+            self.thread = threading.Thread(target=self._work, daemon=True)
+            self.thread.start()
+
+    def write(self, rownum, data):
+        '''add rows starting at rownum, rows have to come in order;
+        data: dict of band name -> array of nrows * width (or (nrows, width)) values'''
+        data = {name: np.ravel(values) for name, values in data.items()}
+        nrows = next(iter(data.values())).size // self.width
+        if self.start is None:
+            self.start = rownum
+        if rownum != self.start + self.filled:
+            raise ValueError('Rows must be written in order, expected row {}'.format(self.start + self.filled))
+
+        offset = 0
+        while offset < nrows:
+            n = min(nrows - offset, self.block_height - self.filled)
+            for name, values in data.items():
+                self.buffer[name][self.filled * self.width:(self.filled + n) * self.width] = \
+                    values[offset * self.width:(offset + n) * self.width]
+            self.filled += n
+            offset += n
+            if self.filled == self.block_height:
+                self.flush()
+
+    def flush(self):
+        if not self.filled:
+            return
+        if self.error is not None:
+            raise self.error
+        job = (self.start, self.filled, self.buffer)
+        if self.jobs is None:
+            self._write(*job)
+        else:
+            self.jobs.put(job)
+            # waits for the previous block to be written
+            self.buffer = self.free.get()
+        self.start += self.filled
+        self.filled = 0
+
+    def close(self):
+        '''write the remaining rows and wait for the background writes'''
+        self.flush()
+        if self.jobs is not None:
+            self.jobs.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _write(self, rownum, nrows, buffer):
+        from snappy import ProductData
+
+        for name, band in self.bands.items():
+            band.writeRasterData(0, rownum, self.width, nrows,
+                                 ProductData.createInstance(buffer[name][:nrows * self.width]))
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                break
+            try:
+                if self.error is None:
+                    self._write(*job)
+            except Exception as error:
+                self.error = error
+            self.free.put(job[2])
+
+
 class utils:
+    # extents of product files, see get_extent
+    extent_cache = {}
+
     def get_resampled(self, s2_product, resolution=20, method='Bilinear'):
         '''method: Nearest, Bilinear'''
         GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
@@ -295,49 +519,206 @@ class utils:
         op.setGeoRegion(grid)
         return op.getTargetProduct()
 
+    def get_preprocessed(self, product, wkt, resolution=20, band_names=None, crs=None, margin=0.005,
+                         method='Bilinear'):
+        '''ROI-first preprocessing: subset -> resample -> reproject (if crs is given), so that only the pixels of the
+        region and the selected bands are resampled.
+        wkt: region of interest, whole product if None
+        margin: widening of the wkt region (in degrees) so that the resampling kernels have valid edges
+        band_names: bands to keep, all if None; only these are kept, so list the angle bands too if they are needed
+        later (e.g. by info.load_block)'''
+        GPF.getDefaultInstance().getOperatorSpiRegistry().loadOperatorSpis()
+
+        HashMap = jpy.get_type('java.util.HashMap')
+        WKTReader = jpy.get_type('com.vividsolutions.jts.io.WKTReader')
+
+        parameters = HashMap()
+        if wkt is not None:
+            parameters.put('geoRegion', WKTReader().read(wkt).buffer(margin))
+        parameters.put('copyMetadata', True)
+        if band_names is not None:
+            parameters.put('bandNames', jpy.array('java.lang.String', list(band_names)))
+        if product.isMultiSize():
+            # the region is mapped on the grid of a band at the target resolution
+            parameters.put('referenceBand', self.get_reference_band(product, resolution, band_names))
+        subset = GPF.createProduct('Subset', parameters, product)
+
+        resampled = self.get_resampled(subset, resolution=resolution, method=method)
+        if crs is None:
+            return resampled
+        return self.getReprojected(resampled, crs=crs, method=method)
+
+    def get_reference_band(self, product, resolution, band_names=None):
+        '''name of the band whose pixel size is the closest to resolution'''
+        bands = [product.getBand(name) for name in band_names] if band_names is not None else product.getBands()
+        sizes = [abs(band.getImageToModelTransform().getScaleX()) for band in bands]
+        return bands[int(np.argmin(np.abs(np.array(sizes) - resolution)))].getName()
+
+    def export_memmap(self, product, folder, band_names=None, max_ram_bytes=256e6):
+        '''stream bands of a (single size) product into folder/data.npy, a (bands, height, width) float32 memmap,
+        with a metadata.json sidecar holding the geocoding, band metadata and export progress.
+        Tiles of as many rows as fit in max_ram_bytes are read straight into the memmap and flushed one by one;
+        an interrupted export resumes from the last flushed tile.'''
+        if band_names is None:
+            band_names = list(product.getBandNames())
+        width, height = product.getSceneRasterWidth(), product.getSceneRasterHeight()
+        for name in band_names:
+            band = product.getBand(name)
+            if band.getRasterWidth() != width or band.getRasterHeight() != height:
+                raise ValueError('Band {} is not at the scene size, resample the product first '
+                                 '(see get_preprocessed)'.format(name))
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        data_file = os.path.join(folder, 'data.npy')
+        metadata = self.get_export_metadata(product, band_names)
+        previous = self.read_export_metadata(folder)
+        # resumed only if it is the same product (name, sensing start) with the same size and bands
+        if previous is not None and os.path.isfile(data_file) and \
+                (previous.get('name'), previous.get('start_time'), previous['width'], previous['height'],
+                 list(previous['rows_done'])) == (metadata['name'], metadata['start_time'], width, height, band_names):
+            data = np.load(data_file, mmap_mode='r+')
+            metadata['rows_done'] = previous['rows_done']
+        else:
+            data = np.lib.format.open_memmap(data_file, mode='w+', dtype=np.float32,
+                                             shape=(len(band_names), height, width))
+            metadata['rows_done'] = {name: 0 for name in band_names}
+
+        tile_height = int(max(1, min(height, max_ram_bytes // (4 * width))))
+        for iband, name in enumerate(band_names):
+            band = product.getBand(name)
+            for rownum in range(metadata['rows_done'][name], height, tile_height):
+                nrows = min(tile_height, height - rownum)
+                band.readPixels(0, rownum, width, nrows, data[iband, rownum:rownum + nrows].reshape(-1))
+                data.flush()
+                metadata['rows_done'][name] = rownum + nrows
+                self.write_export_metadata(folder, metadata)
+            band.unloadRasterData()
+        return data
+
+    def load_export(self, folder, mode='r'):
+        '''memmap (bands, height, width) and metadata of an export_memmap folder'''
+        return np.load(os.path.join(folder, 'data.npy'), mmap_mode=mode), self.read_export_metadata(folder)
+
+    def get_export_metadata(self, product, band_names):
+        metadata = {'name': product.getName(),
+                    'start_time': str(product.getStartTime()),
+                    'width': product.getSceneRasterWidth(),
+                    'height': product.getSceneRasterHeight(),
+                    'bands': [{'name': name,
+                               'wavelength': product.getBand(name).getSpectralWavelength(),
+                               'bandwidth': product.getBand(name).getSpectralBandwidth(),
+                               'unit': product.getBand(name).getUnit(),
+                               'no_data_value': product.getBand(name).getNoDataValue(),
+                               'no_data_used': product.getBand(name).isNoDataValueUsed(),
+                               'description': product.getBand(name).getDescription()}
+                              for name in band_names]}
+
+        metadata['crs'] = None
+        metadata['transform'] = None
+        geocoding = product.getSceneGeoCoding()
+        metadata['extent'] = self.get_extent(product) if geocoding is not None else None
+        try:
+            metadata['crs'] = geocoding.getMapCRS().toWKT()
+            # affine image to map transform of map projected products: x, y = a * col + b * row + c, ...
+            transform = geocoding.getImageToMapTransform()
+            metadata['transform'] = [transform.getScaleX(), transform.getShearX(), transform.getTranslateX(),
+                                     transform.getShearY(), transform.getScaleY(), transform.getTranslateY()]
+        except (AttributeError, RuntimeError):
+            # products without geocoding, or tie point geocodings without affine transform: the extent is kept
+            pass
+        return metadata
+
+    @staticmethod
+    def read_export_metadata(folder):
+        filename = os.path.join(folder, 'metadata.json')
+        if not os.path.isfile(filename):
+            return None
+        with open(filename) as file:
+            return json.load(file)
+
+    @staticmethod
+    def write_export_metadata(folder, metadata):
+        with atomic_path(os.path.join(folder, 'metadata.json')) as tmp_filename, open(tmp_filename, 'w') as file:
+            json.dump(metadata, file, indent=1)
+
     def print_array(self, arr):
         np.set_printoptions(threshold=np.nan)
         print
         arr
 
-    def getMinMax(self, current, minV, maxV):
-        if current < minV:
-            minV = current
-        if current > maxV:
-            maxV = current
-        return [minV, maxV]
-
-    def get_extent(self, product):
+    def get_extent(self, product, step=None, tolerance=1e-4):
         '''Get corner coordinates of the ESA SNAP product(getextent)
         ########
-        # int step - the step given in pixels'''
-        step = 1
-        lonmin = 999.99
-
-        GeoPos = ProductUtils.createGeoBoundary(product, step)
-
-        lonmax = -lonmin
-        latmin = lonmin
-        latmax = lonmax
-
-        for element in GeoPos:
-            try:
-                lon = element.getLon()
-                [lonmin, lonmax] = self.getMinMax(lon, lonmin, lonmax)
-            except (NameError):
-                pass
-            try:
-                # TODO: separate method to get min and max
-                lat = element.getLat()
-                [latmin, latmax] = self.getMinMax(lat, latmin, latmax)
-            except (NameError):
-                pass
+        # int step - coarse step of the boundary sampling in pixels, refined where the boundary bends
+        # (default: 1/16 of the largest side)
+        # float tolerance - largest deviation in degrees from a straight boundary segment
+        Extents are cached per product file and raster: subsets and resampled products built by GPF can report
+        the file location of their source.'''
+        key = None
+        location = product.getFileLocation()
+        if location is not None:
+            path = str(location.getAbsolutePath())
+            key = (path, os.path.getmtime(path) if os.path.exists(path) else None, product.getName(),
+                   product.getSceneRasterWidth(), product.getSceneRasterHeight(), step, tolerance)
+            if key in self.extent_cache:
+                return self.extent_cache[key]
+
+        lon, lat = self.sample_boundary(product, step, tolerance)
+        lonmin, lonmax = float(np.nanmin(lon)), float(np.nanmax(lon))
+        latmin, latmax = float(np.nanmin(lat)), float(np.nanmax(lat))
         wkt = "POLYGON((" + str(lonmax) + " " + str(latmax) + "," + str(lonmax) + " " \
               + str(latmin) + "," + str(lonmin) + " " + str(latmin) + "," + str(lonmin) + " " \
               + str(latmax) + "," + str(lonmax) + " " + str(latmax) + "))"
 
+        if key is not None:
+            self.extent_cache[key] = wkt
         return wkt
 
+    def sample_boundary(self, product, step=None, tolerance=1e-4):
+        '''lon, lat arrays of boundary pixels: corners and every step pixels along the edges, geocoded in one call of
+        ProductUtils.createGeoBoundary, then segments are bisected while their midpoint deviates from the straight line
+        by more than tolerance degrees'''
+        geocoding = product.getSceneGeoCoding()
+        PixelPos = jpy.get_type('org.esa.snap.core.datamodel.PixelPos')
+        ProductUtils = jpy.get_type('org.esa.snap.core.util.ProductUtils')
+        Rectangle = jpy.get_type('java.awt.Rectangle')
+        width, height = product.getSceneRasterWidth(), product.getSceneRasterHeight()
+        step = step or max(1, max(width, height) // 16)
+
+        def to_array(pos):
+            return np.array([pos.getLon(), pos.getLat()]) if pos.isValid() else np.array([np.nan, np.nan])
+
+        def get_geo(x, y):
+            return to_array(geocoding.getGeoPos(PixelPos(float(x) + 0.5, float(y) + 0.5), None))
+
+        points = []
+
+        def refine(start, geo_start, stop, geo_stop):
+            if max(abs(stop[0] - start[0]), abs(stop[1] - start[1])) <= 1:
+                return
+            middle = ((start[0] + stop[0]) // 2, (start[1] + stop[1]) // 2)
+            geo_middle = get_geo(*middle)
+            points.append(geo_middle)
+            if not np.all(np.abs(geo_middle - (geo_start + geo_stop) / 2.) <= tolerance):
+                refine(start, geo_start, middle, geo_middle)
+                refine(middle, geo_middle, stop, geo_stop)
+
+        # the ring of pixel centres at the step, clockwise from the upper-left corner, and its geo positions
+        rect = Rectangle(0, 0, width, height)
+        nodes = [(int(pos.getX()), int(pos.getY())) for pos in ProductUtils.createRectBoundary(rect, step, True)]
+        geos = [to_array(pos) for pos in ProductUtils.createGeoBoundary(product, rect, step, True)]
+        if len(geos) != len(nodes):
+            # positions outside the geocoding dropped, geocode the nodes one by one
+            geos = [get_geo(*node) for node in nodes]
+        points.extend(geos)
+        for index in range(len(nodes)):
+            following = (index + 1) % len(nodes)
+            refine(nodes[index], geos[index], nodes[following], geos[following])
+
+        points = np.array(points)
+        return points[:, 0], points[:, 1]
+
     def getReprojected(self, product, crs='EPSG:4326', method='Bilinear'):
         '''Reproject a snappy product on a given coordinate reference system (crs)'''
         from snappy import GPF